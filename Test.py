@@ -3,12 +3,27 @@ from unittest.mock import patch, MagicMock
 import sqlite3
 import json
 import os
+import tempfile
+import threading
+import time
 import base64
+from datetime import datetime, timedelta, timezone
 from io import StringIO
+from googleapiclient.errors import HttpError
 
 # Import the modules to be tested.
+import daemon
 import fetch
 import rules
+import rule_engine
+import gmail_client
+import metrics
+import payload
+import rule_store
+import search
+import session
+import storage
+import transport
 
 #####################################
 # DummyConnection: Subclass sqlite3.Connection to override close()
@@ -18,6 +33,39 @@ class DummyConnection(sqlite3.Connection):
         # Override close() so that our in-memory DB stays accessible during tests.
         pass
 
+#####################################
+# FakeBatch: Stand-in for googleapiclient's BatchHttpRequest
+#####################################
+class FakeBatch:
+    def __init__(self, callback, responses):
+        self.callback = callback
+        self.responses = responses
+        self.request_ids = []
+
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+
+    def execute(self, http=None):
+        # Each response is either a message dict or an exception passed to the callback.
+        for request_id in self.request_ids:
+            response = self.responses[request_id].pop(0)
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
+
+#####################################
+# Helpers: fake Gmail messages and errors
+#####################################
+def fake_message(msg_id, label_ids=('UNREAD',)):
+    return {'id': msg_id, 'internalDate': '1', 'labelIds': list(label_ids),
+            'payload': {'headers': [{'name': 'From', 'value': f'{msg_id}@example.com'}]}}
+
+def http_error(status, headers=None):
+    resp = MagicMock(status=status)
+    resp.get.side_effect = (headers or {}).get
+    return HttpError(resp, b'error')
+
 #####################################
 # Integration Test for fetch.py
 #####################################
@@ -40,8 +88,8 @@ class TestFetchEmails(unittest.TestCase):
         ''')
         self.conn.commit()
         
-        # Patch sqlite3.connect in fetch so it always returns our in-memory DB.
-        self.sqlite_patcher = patch('fetch.sqlite3.connect', lambda db_name="emails.db": self.conn)
+        # Patch sqlite3.connect in the storage layer so it always returns our in-memory DB.
+        self.sqlite_patcher = patch('storage.sqlite3.connect', lambda db_name="emails.db": self.conn)
         self.sqlite_patcher.start()
 
         # Patch os.path.exists globally so that token.pickle is not found.
@@ -77,6 +125,11 @@ class TestFetchEmails(unittest.TestCase):
         self.build_patcher = patch('fetch.build', return_value=self.fake_service)
         self.build_patcher.start()
 
+    def get_state(self, key):
+        self.cursor.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
     def tearDown(self):
         self.sqlite_patcher.stop()
         self.exists_patcher.stop()
@@ -112,6 +165,938 @@ class TestFetchEmails(unittest.TestCase):
             # Fixed assertion: check for the exact confirmation message.
             self.assertIn("Emails stored successfully in the database!", output.getvalue())
 
+    def test_fetch_emails_batched(self):
+        """
+        Integration Test for batched fetching:
+        - Lists three messages and fetches them through batch requests of size 2.
+        - A 429 on one item is retried; a 404 on another is skipped.
+        """
+        self.fake_service.users.return_value.messages.return_value.list.return_value.execute.return_value = {
+            'messages': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+        }
+        responses = {'a': [fake_message('a')], 'b': [http_error(429), fake_message('b')], 'c': [http_error(404)]}
+        batches = []
+
+        def new_batch(callback):
+            batches.append(FakeBatch(callback, responses))
+            return batches[-1]
+
+        self.fake_service.new_batch_http_request.side_effect = new_batch
+        with patch('gmail_client.time.sleep'):
+            fetch.fetch_emails(batch_size=2, log_callback=lambda msg: None)
+
+        self.assertEqual([batch.request_ids for batch in batches], [['a', 'b'], ['b'], ['c']])
+        self.cursor.execute("SELECT id, sender, is_read FROM emails ORDER BY id")
+        self.assertEqual(self.cursor.fetchall(), [('a', 'a@example.com', 0), ('b', 'b@example.com', 0)])
+
+    def test_fetch_emails_walks_all_pages(self):
+        """
+        Integration Test for pagination:
+        - The "timestamp" method follows nextPageToken until the last page.
+        - iter_message_ids stops at the hard limit without listing further pages.
+        """
+        pages = {
+            None: {'messages': [{'id': 'p1'}, {'id': 'p2'}], 'nextPageToken': 'page2'},
+            'page2': {'messages': [{'id': 'p3'}]},
+        }
+        messages_api = self.fake_service.users.return_value.messages.return_value
+
+        def list_messages(**params):
+            return MagicMock(execute=MagicMock(return_value=pages[params.get('pageToken')]))
+
+        def get_message(userId, id):
+            return MagicMock(execute=MagicMock(return_value={'id': id, 'payload': {}}))
+
+        messages_api.list.side_effect = list_messages
+        messages_api.get.side_effect = get_message
+
+        fetch.fetch_emails(retrieval_method="timestamp", number_or_date="2024-01-01", page_size=2,
+                           log_callback=lambda msg: None)
+        self.cursor.execute("SELECT id FROM emails ORDER BY id")
+        self.assertEqual([row[0] for row in self.cursor.fetchall()], ['p1', 'p2', 'p3'])
+        self.assertEqual(messages_api.list.call_args_list[0].kwargs,
+                         {'userId': 'me', 'q': 'after:2024-01-01', 'maxResults': 2})
+
+        messages_api.list.reset_mock()
+        ids = list(fetch.iter_message_ids(self.fake_service, {'userId': 'me'}, page_size=2, limit=2))
+        self.assertEqual(ids, ['p1', 'p2'])
+        self.assertEqual(messages_api.list.call_count, 1)
+
+    def test_fetch_emails_incremental(self):
+        """
+        Integration Test for historyId-based sync:
+        - The first run has no stored history id, so it does a full sync and records one.
+        - The second run fetches only added messages, skipping those added to spam or trash,
+          and updates is_read from label changes.
+        - An expired history id falls back to a full sync.
+        """
+        users_api = self.fake_service.users.return_value
+        users_api.getProfile.return_value.execute.return_value = {'historyId': '100'}
+        log = lambda msg: None
+
+        fetch.fetch_emails(retrieval_method="incremental", log_callback=log)
+        self.assertEqual(self.get_state('history_id'), '100')
+        self.cursor.execute("SELECT is_read FROM emails WHERE id='test_id'")
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+
+        users_api.history.return_value.list.return_value.execute.return_value = {
+            'history': [
+                {'messagesAdded': [{'message': {'id': 'new_id', 'labelIds': ['INBOX', 'UNREAD']}},
+                                   {'message': {'id': 'spam_id', 'labelIds': ['SPAM', 'UNREAD']}},
+                                   {'message': {'id': 'trash_id', 'labelIds': ['TRASH']}}]},
+                {'labelsAdded': [{'message': {'id': 'test_id'}, 'labelIds': ['UNREAD']}]},
+            ],
+            'historyId': '150',
+        }
+        users_api.messages.return_value.get.return_value.execute.return_value = {
+            'id': 'new_id', 'labelIds': ['UNREAD'], 'payload': {}
+        }
+        users_api.messages.return_value.list.reset_mock()
+        users_api.messages.return_value.get.reset_mock()
+        fetch.fetch_emails(retrieval_method="incremental", log_callback=log)
+
+        users_api.history.return_value.list.assert_called_with(
+            userId='me', startHistoryId='100', historyTypes=['messageAdded', 'labelAdded', 'labelRemoved'],
+            maxResults=500
+        )
+        users_api.messages.return_value.list.assert_not_called()
+        users_api.messages.return_value.get.assert_called_once_with(userId='me', id='new_id')
+        self.cursor.execute("SELECT id, is_read FROM emails ORDER BY id")
+        self.assertEqual(self.cursor.fetchall(), [('new_id', 0), ('test_id', 0)])
+        self.assertEqual(self.get_state('history_id'), '150')
+
+        users_api.history.return_value.list.return_value.execute.side_effect = http_error(404)
+        users_api.getProfile.return_value.execute.return_value = {'historyId': '300'}
+        fetch.fetch_emails(retrieval_method="incremental", log_callback=log)
+        users_api.messages.return_value.list.assert_called()
+        self.assertEqual(self.get_state('history_id'), '300')
+
+    def test_fetch_emails_keeps_history_id_while_emails_fail(self):
+        """
+        Integration Test for batch items that keep failing:
+        - Per-item 5xx errors are retried like rate limits.
+        - Emails still failing after the retries leave the history id where it was, so
+          the next incremental run fetches them.
+        """
+        users_api = self.fake_service.users.return_value
+        users_api.getProfile.return_value.execute.return_value = {'historyId': '100'}
+        fetch.fetch_emails(retrieval_method="incremental", log_callback=lambda msg: None)
+        users_api.history.return_value.list.return_value.execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'x'}}, {'message': {'id': 'y'}}]}],
+            'historyId': '150',
+        }
+
+        unavailable = http_error(503)
+        responses = {'x': [unavailable, fake_message('x')], 'y': [unavailable] * 6 + [fake_message('y')]}
+        self.fake_service.new_batch_http_request.side_effect = lambda callback: FakeBatch(callback, responses)
+        logs = []
+        with patch('gmail_client.time.sleep'):
+            fetch.fetch_emails(retrieval_method="incremental", batch_size=10, log_callback=logs.append)
+            self.assertIn("1 emails could not be fetched; they will be retried on the next run.", logs)
+            self.assertEqual(self.get_state('history_id'), '100')
+            self.cursor.execute("SELECT id FROM emails WHERE id IN ('x', 'y')")
+            self.assertEqual(self.cursor.fetchall(), [('x',)])
+
+            fetch.fetch_emails(retrieval_method="incremental", batch_size=10, log_callback=logs.append)
+        self.assertEqual(self.get_state('history_id'), '150')
+        self.cursor.execute("SELECT id FROM emails WHERE id IN ('x', 'y') ORDER BY id")
+        self.assertEqual(self.cursor.fetchall(), [('x',), ('y',)])
+
+    def test_fetch_emails_stops_between_chunks_when_cancelled(self):
+        """
+        Integration Test for cancellation:
+        - Once the cancel event is set, no further chunks are fetched, even when stored
+          emails are not logged (log_every=0), so Cancel does not wait for a log line.
+        - Emails already fetched are stored, and the history id is kept for the next run.
+        """
+        users_api = self.fake_service.users.return_value
+        users_api.getProfile.return_value.execute.return_value = {'historyId': '100'}
+        fetch.fetch_emails(retrieval_method="incremental", log_callback=lambda msg: None)
+        users_api.history.return_value.list.return_value.execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'x'}}, {'message': {'id': 'y'}}]}],
+            'historyId': '150',
+        }
+        responses = {msg_id: [fake_message(msg_id, label_ids=())] for msg_id in ('x', 'y')}
+        cancel = threading.Event()
+
+        def new_batch(callback):
+            # Cancel is pressed while the first chunk is being fetched.
+            cancel.set()
+            return FakeBatch(callback, responses)
+
+        self.fake_service.new_batch_http_request.side_effect = new_batch
+        logs = []
+        fetch.fetch_emails(retrieval_method="incremental", batch_size=1, log_callback=logs.append, log_every=0,
+                           cancel=cancel)
+
+        self.assertIn("Fetch cancelled after storing 1 emails; fetch again (with resume) to continue.", logs)
+        self.assertEqual(self.get_state('history_id'), '100')
+        self.cursor.execute("SELECT id FROM emails WHERE id IN ('x', 'y')")
+        self.assertEqual(self.cursor.fetchall(), [('x',)])
+
+    def test_fetch_emails_skips_stored_ids(self):
+        """
+        Integration Test for the pre-filter stage:
+        - Ids already in the emails table are not fetched again, and the skip count is logged.
+        """
+        self.cursor.execute("INSERT INTO emails (id, sender) VALUES ('known_id', 'old@example.com')")
+        self.conn.commit()
+        messages_api = self.fake_service.users.return_value.messages.return_value
+        messages_api.list.return_value.execute.return_value = {
+            'messages': [{'id': 'known_id'}, {'id': 'test_id'}]
+        }
+        logs = []
+
+        fetch.fetch_emails(log_callback=logs.append)
+
+        messages_api.get.assert_called_once_with(userId='me', id='test_id')
+        self.assertIn("Skipped fetching 1 already-stored emails.", logs)
+
+    def test_fetch_emails_metadata_format(self):
+        """
+        Integration Test for metadata-only fetches:
+        - Messages are requested in metadata format and stored without a body.
+        - hydrate_bodies() later downloads the full messages with batch requests and fills
+          in the bodies, skipping emails at or below `after_rowid`.
+        """
+        messages_api = self.fake_service.users.return_value.messages.return_value
+
+        fetch.fetch_emails(message_format="metadata", log_callback=lambda msg: None)
+        messages_api.get.assert_called_once_with(userId='me', id='test_id', format='metadata',
+                                                 metadataHeaders=fetch.METADATA_HEADERS)
+        self.cursor.execute("SELECT sender, message FROM emails WHERE id='test_id'")
+        self.assertEqual(self.cursor.fetchone(), ('test@example.com', None))
+
+        batches = []
+
+        def new_batch(callback):
+            batches.append(FakeBatch(callback, {'test_id': [messages_api.get.return_value.execute.return_value]}))
+            return batches[-1]
+
+        self.fake_service.new_batch_http_request.side_effect = new_batch
+        store = storage.EmailStore()
+        # The fake message has no UNREAD label, so it is stored as read.
+        hydrate = lambda **kwargs: fetch.hydrate_bodies(self.fake_service, store, unread_only=False,
+                                                        log_callback=lambda msg: None, **kwargs)
+        self.assertEqual(hydrate(after_rowid=store.max_rowid()), 0)
+        self.assertEqual(hydrate(), 1)
+        self.assertEqual(hydrate(), 0)
+        self.assertEqual([batch.request_ids for batch in batches], [['test_id']])
+        messages_api.get.assert_called_with(userId='me', id='test_id')
+        store.close()
+        self.cursor.execute("SELECT message FROM emails WHERE id='test_id'")
+        self.assertEqual(self.cursor.fetchone()[0], 'This is a test email body')
+
+    def test_fetch_emails_concurrent_pipeline(self):
+        """
+        Integration Test for the concurrent pipeline:
+        - All listed messages are stored, with no more than `concurrency` fetches in flight.
+        - A failing fetch stops the pipeline and surfaces the original error.
+        """
+        messages_api = self.fake_service.users.return_value.messages.return_value
+        messages_api.list.return_value.execute.return_value = {'messages': [{'id': str(i)} for i in range(30)]}
+        state = {'active': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def get_message(userId, id):
+            def execute(http=None):
+                with lock:
+                    state['active'] += 1
+                    state['peak'] = max(state['peak'], state['active'])
+                time.sleep(0.005)
+                with lock:
+                    state['active'] -= 1
+                if id == 'bad':
+                    raise http_error(400)
+                return {'id': id, 'payload': {}}
+            return MagicMock(execute=execute)
+
+        messages_api.get.side_effect = get_message
+        fetch.fetch_emails(number_or_date="30", concurrency=4, page_size=8, log_callback=lambda msg: None)
+        self.cursor.execute("SELECT COUNT(*) FROM emails")
+        self.assertEqual(self.cursor.fetchone()[0], 30)
+        self.assertLessEqual(state['peak'], 4)
+        self.assertGreater(state['peak'], 1)
+
+        messages_api.list.return_value.execute.return_value = {'messages': [{'id': 'bad'}]}
+        with self.assertRaises(HttpError):
+            fetch.fetch_emails(concurrency=2, log_callback=lambda msg: None)
+
+    def test_fetch_emails_resumes_from_checkpoint(self):
+        """
+        Integration Test for resumable syncs:
+        - A run that fails on the third page keeps the first two pages and a checkpoint.
+        - resume=True continues listing at the third page without refetching stored emails.
+        - The checkpoint is removed once the run completes.
+        """
+        pages = {
+            None: {'messages': [{'id': 'a1'}, {'id': 'a2'}], 'nextPageToken': 'page2'},
+            'page2': {'messages': [{'id': 'b1'}, {'id': 'b2'}], 'nextPageToken': 'page3'},
+            'page3': {'messages': [{'id': 'c1'}, {'id': 'c2'}]},
+        }
+        messages_api = self.fake_service.users.return_value.messages.return_value
+        failing = {'c1'}
+
+        def list_messages(**params):
+            return MagicMock(execute=MagicMock(return_value=pages[params.get('pageToken')]))
+
+        def get_message(userId, id):
+            def execute(http=None):
+                if id in failing:
+                    raise http_error(400)
+                return {'id': id, 'payload': {}}
+            return MagicMock(execute=execute)
+
+        messages_api.list.side_effect = list_messages
+        messages_api.get.side_effect = get_message
+        log = lambda msg: None
+
+        for concurrency in (1, 3):
+            with self.subTest(concurrency=concurrency):
+                self.cursor.execute("DELETE FROM emails")
+                self.conn.commit()
+                failing.add('c1')
+                with self.assertRaises(HttpError):
+                    fetch.fetch_emails(retrieval_method="timestamp", number_or_date="2024-01-01", page_size=2,
+                                       concurrency=concurrency, log_callback=log)
+                checkpoint = json.loads(self.get_state('fetch_checkpoint'))
+                if concurrency == 1:
+                    self.assertEqual((checkpoint['page_token'], checkpoint['listed']), ('page3', 4))
+                else:
+                    # The pipeline may fail before page 2 is fully stored; the checkpoint never runs ahead.
+                    self.assertIn((checkpoint['page_token'], checkpoint['listed']), [('page2', 2), ('page3', 4)])
+
+                failing.clear()
+                messages_api.list.reset_mock()
+                messages_api.get.reset_mock()
+                fetch.fetch_emails(retrieval_method="timestamp", number_or_date="2024-01-01", page_size=2,
+                                   concurrency=concurrency, resume=True, log_callback=log)
+                self.assertEqual(messages_api.list.call_args_list[0].kwargs.get('pageToken'),
+                                 checkpoint['page_token'])
+                fetched = {call.kwargs['id'] for call in messages_api.get.call_args_list}
+                self.assertIn('c1', fetched)
+                self.assertLessEqual(fetched, {'c1', 'c2'} if concurrency == 1 else {'b1', 'b2', 'c1', 'c2'})
+                self.cursor.execute("SELECT COUNT(*) FROM emails")
+                self.assertEqual(self.cursor.fetchone()[0], 6)
+                self.assertIsNone(self.get_state('fetch_checkpoint'))
+
+#####################################
+# Unit Tests for session.py
+#####################################
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        session.reset()
+
+    def tearDown(self):
+        session.reset()
+
+    def test_credentials_and_service_are_reused_and_refreshed_early(self):
+        """
+        Unit Test:
+        - Credentials are loaded and the service is built once per process.
+        - Credentials close to expiry are refreshed and saved before being returned.
+        - The cold-start timings are reported once.
+        """
+        utcnow = lambda: datetime.now(timezone.utc).replace(tzinfo=None)
+        creds = MagicMock(refresh_token='refresh', expiry=utcnow() + timedelta(hours=1))
+        with patch('session.auth.authenticate', return_value=creds) as load, \
+                patch('session.auth.save_token') as save_token, \
+                patch('googleapiclient.discovery.build', return_value=MagicMock()) as build:
+            self.assertIs(session.authenticate('credentials.json'), creds)
+            service = session.build('gmail', 'v1', credentials=creds)
+            self.assertIs(session.authenticate('credentials.json'), creds)
+            self.assertIs(session.build('gmail', 'v1', credentials=creds), service)
+            self.assertEqual((load.call_count, build.call_count), (1, 1))
+            creds.refresh.assert_not_called()
+
+            creds.expiry = utcnow() + timedelta(minutes=1)
+            session.authenticate('credentials.json')
+            creds.refresh.assert_called_once()
+            save_token.assert_called_once_with(creds)
+
+        self.assertIn("Gmail session ready", session.cold_start_summary())
+        self.assertIsNone(session.cold_start_summary())
+
+#####################################
+# Unit Tests for gmail_client.py
+#####################################
+class TestGmailClient(unittest.TestCase):
+
+    def test_execute_retries_with_backoff_and_retry_after(self):
+        """
+        Unit Test:
+        - 429 and 5xx responses are retried, honouring Retry-After, and counted in stats.
+        - A rate limit halves the token bucket rate.
+        - Non-retryable errors are raised immediately.
+        """
+        client = gmail_client.GmailClient()
+        request = MagicMock()
+        request.execute.side_effect = [http_error(429, {'retry-after': '3'}), http_error(503), {'ok': True}]
+        with patch('gmail_client.time.sleep') as sleep:
+            self.assertEqual(client.execute(request, 'messages.get'), {'ok': True})
+        self.assertEqual(sleep.call_args_list[0].args, (3.0,))
+        self.assertEqual(client.stats['retries'], 2)
+        self.assertEqual(client.stats['calls'], 3)
+        self.assertLess(client.bucket.rate, gmail_client.DEFAULT_UNITS_PER_SECOND)
+
+        request.execute.side_effect = [http_error(404)]
+        with self.assertRaises(Exception):
+            client.execute(request, 'messages.get')
+        self.assertEqual(client.stats['calls'], 4)
+
+    def test_batch_requests_are_charged_in_full_and_retried(self):
+        """
+        Unit Test:
+        - A batch request is charged the quota of all its calls and retried on a 5xx like
+          any other request.
+        """
+        client = gmail_client.GmailClient()
+        batch = MagicMock()
+        batch.execute.side_effect = [http_error(503), None]
+        with patch.object(client.bucket, 'acquire', return_value=0.0) as acquire, \
+                patch('gmail_client.time.sleep'):
+            client.execute(batch, 'messages.get', calls=100)
+        self.assertEqual(batch.execute.call_count, 2)
+        self.assertEqual([call.args for call in acquire.call_args_list], [(500,), (500,)])
+        self.assertEqual(client.metrics.total('api_calls'), 200)
+
+    def test_circuit_breaker_opens_after_repeated_failures(self):
+        """
+        Unit Test:
+        - After failure_threshold calls exhaust their retries, calls are rejected without
+          reaching Gmail until reset_timeout has passed.
+        """
+        client = gmail_client.GmailClient(max_retries=0, failure_threshold=2, reset_timeout=60)
+        request = MagicMock()
+        request.execute.side_effect = http_error(500)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                client.execute(request, 'messages.list')
+        with self.assertRaises(gmail_client.CircuitOpenError):
+            client.execute(request, 'messages.list')
+        self.assertEqual(request.execute.call_count, 2)
+        self.assertEqual(client.stats['circuit_opens'], 1)
+
+    def test_execute_borrows_pooled_connections(self):
+        """
+        Unit Test:
+        - Requests run on connections lent by the client's HttpPool and returned after use,
+          so sequential calls reuse one connection; an explicit http bypasses the pool.
+        - Pooled connections send the pool's Accept-Encoding header.
+        """
+        pool = transport.HttpPool(size=2, gzip=False)
+        client = gmail_client.GmailClient(pool=pool)
+        request = MagicMock()
+        request.execute.return_value = {'ok': True}
+        for _ in range(3):
+            client.execute(request, 'messages.get')
+        used = {call.kwargs['http'] for call in request.execute.call_args_list}
+        self.assertEqual(len(used), 1)
+        self.assertEqual(pool.stats, {'opened': 1, 'acquired': 3, 'waited': 0})
+        own = object()
+        client.execute(request, 'messages.get', http=own)
+        self.assertIs(request.execute.call_args.kwargs['http'], own)
+
+        connection = used.pop()
+        with patch.object(connection.http, 'request', return_value=('response', b'')) as send:
+            connection.request('https://gmail.googleapis.com/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(send.call_args.args[3], {'accept-encoding': 'identity'})
+
+        with pool.acquire() as first, pool.acquire() as second:
+            self.assertIsNot(first, second)
+        self.assertEqual(pool.stats['opened'], 2)
+        pool.close()
+        self.assertEqual(pool.stats['opened'], 0)
+
+    def test_token_bucket_waits_when_empty(self):
+        """
+        Unit Test:
+        - Acquiring more units than are available sleeps for the refill time.
+        - Requests larger than the capacity are charged in full, so batches cannot exceed
+          the rate.
+        """
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with patch('gmail_client.time.monotonic', lambda: clock[0]), patch('gmail_client.time.sleep', sleep):
+            bucket = gmail_client.TokenBucket(rate=100, capacity=10)
+            self.assertEqual(bucket.acquire(10), 0.0)
+            self.assertAlmostEqual(bucket.acquire(5), 0.05)
+            self.assertAlmostEqual(clock[0], 0.05)
+
+            clock[0] = 0.0
+            bucket = gmail_client.TokenBucket(rate=250)
+            for _ in range(4):
+                bucket.acquire(500)
+            # 2000 units at 250/s, less the initial burst of 250.
+            self.assertAlmostEqual(clock[0], 7.0)
+
+#####################################
+# Unit Tests for storage.py
+#####################################
+class TestEmailStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = storage.EmailStore(':memory:', batch_rows=2, batch_seconds=60)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_insert_emails_commits_in_batches(self):
+        """
+        Unit Test:
+        - Rows are buffered until batch_rows is reached, then written with one executemany.
+        - Buffered ids are already excluded by filter_unknown_ids.
+        """
+        self.store.insert_emails([('1', 'a@example.com', '', '', '', 0)])
+        self.store.cursor.execute("SELECT COUNT(*) FROM emails")
+        self.assertEqual(self.store.cursor.fetchone()[0], 0)
+        self.assertEqual(self.store.filter_unknown_ids(['1', '2']), ['2'])
+
+        self.store.insert_emails([('2', 'b@example.com', '', '', '', 0)])
+        self.store.cursor.execute("SELECT COUNT(*) FROM emails")
+        self.assertEqual(self.store.cursor.fetchone()[0], 2)
+        self.assertEqual(list(self.store.iter_unread(('id',), fetch_size=1)), [('1',), ('2',)])
+
+    def test_search_index_follows_emails(self):
+        """
+        Unit Test:
+        - The index is only created on request.
+        - Inserted, updated and deleted emails are reflected in search() through triggers.
+        - Results are ranked, paged, and carry a snippet around the match.
+        - An index added to a database with existing emails is filled, and can be rebuilt.
+        """
+        self.assertFalse(self.store.fts)
+        self.store.cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE 'emails_fts%'")
+        self.assertEqual(self.store.cursor.fetchone()[0], 0)
+        self.store.close()
+        self.store = storage.EmailStore(':memory:', batch_rows=2, batch_seconds=60, fts=True)
+        self.store.insert_emails([
+            ('1', 'billing@shop.com', 'Your invoice', '', 'Invoice 42 is attached. Invoice total: 10', 0),
+            ('2', 'friend@example.com', 'Lunch?', '', 'See you at noon', 0),
+        ])
+        self.assertEqual([row[0] for row in self.store.search('invoice')], ['1'])
+        self.assertEqual(self.store.search('invoice')[0][1], '[Invoice] 42 is attached. [Invoice] total: 10')
+        self.assertEqual(self.store.search('invoice', offset=1), [])
+        self.assertEqual([row[0] for row in self.store.search('subject:lunch OR noon', syntax=True)], ['2'])
+
+        self.store.update_bodies([('Invoice attached', '2')])
+        self.assertEqual(sorted(row[0] for row in self.store.search('invoice')), ['1', '2'])
+        self.store.cursor.execute("DELETE FROM emails WHERE id = '1'")
+        self.assertEqual([row[0] for row in self.store.search('invoice')], ['2'])
+
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, sender TEXT, subject TEXT, message TEXT)")
+        conn.execute("INSERT INTO emails VALUES ('old', 'a@b.com', 'Archived invoice', '')")
+        storage.init_search_index(conn)
+        self.assertEqual(conn.execute("SELECT rowid FROM emails_fts WHERE emails_fts MATCH 'archived'").fetchall(),
+                         [(1,)])
+        conn.close()
+        self.assertTrue(self.store.rebuild_search_index())
+        self.assertEqual([row[0] for row in self.store.search('invoice')], ['2'])
+
+    def test_search_emails_matches_terms_literally(self):
+        """
+        Unit Test:
+        - Addresses and hyphenated terms are searched literally instead of failing as FTS5 syntax.
+        - Terms too short for the trigram index are reported; invalid FTS5 syntax and a
+          missing index are logged instead of raised.
+        """
+        logs = []
+        with patch('search.EmailStore', return_value=self.store), patch.object(self.store, 'close'):
+            self.assertEqual(search.search_emails('invoice', log_callback=logs.append), [])
+            self.assertIn('No search index', logs[-1])
+            self.assertTrue(self.store.rebuild_search_index())
+            self.store.insert_emails([('1', 'a@shop.com', 'Re: order-123', '', 'Shipped', 0)])
+            self.assertEqual([row[0] for row in search.search_emails('a@shop.com order-123', log_callback=logs.append)],
+                             ['1'])
+            self.assertEqual([row[0] for row in search.search_emails('re: is shipped', log_callback=logs.append)],
+                             ['1'])
+            self.assertIn('cannot match: is', logs[-2])
+            self.assertEqual(search.search_emails('order-123', log_callback=logs.append, syntax=True), [])
+            self.assertIn('Search failed', logs[-1])
+
+    def test_init_schema_upgrades_old_tables(self):
+        """
+        Unit Test:
+        - An emails table without received_at gains the column and the lookup indexes.
+        """
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, sender TEXT, is_read INTEGER DEFAULT 0)")
+        storage.init_schema(conn)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(emails)")}
+        indexes = {row[1] for row in conn.execute("PRAGMA index_list(emails)")}
+        self.assertTrue({'subject', 'received_at', 'message'} <= columns)
+        self.assertTrue(set(storage.INDEXES) <= indexes)
+        conn.close()
+
+#####################################
+# Unit Tests for payload.py
+#####################################
+class TestPayload(unittest.TestCase):
+
+    def part(self, mime_type, data, charset=None, **extra):
+        headers = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}] if charset else []
+        encoded = base64.urlsafe_b64encode(data).decode().rstrip('=')
+        return {'mimeType': mime_type, 'headers': headers, 'body': {'data': encoded}, **extra}
+
+    def test_extract_body_walks_nested_parts_with_charsets(self):
+        """
+        Unit Test:
+        - text/plain parts of nested multipart trees are read in order, in their declared charset.
+        - HTML alternatives and attachments are skipped, and unpadded data is decoded.
+        """
+        message = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [
+                self.part('text/plain', 'Café, '.encode('latin-1'), charset='ISO-8859-1'),
+                self.part('text/html', b'<p>ignored</p>'),
+            ]},
+            self.part('text/plain', b'not a body', filename='notes.txt'),
+            self.part('text/plain', 'naïve'.encode('utf-8'), charset='utf-8'),
+        ]}
+        self.assertEqual(payload.extract_body(message), 'Café, naïve')
+        self.assertEqual(payload.extract_body(message, max_chars=3), 'Caf')
+
+    def test_extract_body_falls_back_to_html(self):
+        """
+        Unit Test:
+        - Without text/plain, the text of text/html parts is used with markup and scripts stripped.
+        """
+        message = {'mimeType': 'multipart/alternative', 'parts': [
+            self.part('text/html', b'<html><style>p {}</style><p>Hello &amp; welcome</p></html>'),
+        ]}
+        self.assertEqual(payload.extract_body(message).strip(), 'Hello & welcome')
+        self.assertEqual(payload.extract_body(message, html_fallback=False), '')
+
+#####################################
+# Unit Tests for metrics.py
+#####################################
+class TestMetrics(unittest.TestCase):
+
+    def test_client_and_fetch_record_metrics_and_export(self):
+        """
+        Unit Test:
+        - GmailClient.execute counts calls per method and observes their latency.
+        - summary() reports emails, API calls and calls per email since a snapshot.
+        - Prometheus export has cumulative histogram buckets; .jsonl export appends a line.
+        - LogSampler selects every Nth call, and none by default.
+        """
+        client = gmail_client.GmailClient()
+        request = MagicMock()
+        request.execute.return_value = {}
+        started = client.metrics.snapshot()
+        for _ in range(4):
+            client.execute(request, 'messages.get')
+        client.metrics.count('emails_processed', 2, {'stage': 'fetch'})
+        summary = client.metrics.summary(started)
+        self.assertEqual((summary['emails'], summary['api_calls'], summary['http_requests']), (2, 4, 4))
+        self.assertEqual(summary['api_calls_per_email'], 2.0)
+        self.assertIn("2 emails", metrics.format_summary("Fetch", summary))
+
+        client.metrics.observe('insert_seconds', 0.003)
+        client.metrics.observe('insert_seconds', 20)
+        text = client.metrics.to_prometheus()
+        self.assertIn('email_api_calls_total{method="messages.get"} 4', text)
+        self.assertIn('email_api_latency_seconds_count{method="messages.get"} 4', text)
+        self.assertIn('email_insert_seconds_bucket{le="0.005"} 1', text)
+        self.assertIn('email_insert_seconds_bucket{le="10.0"} 1', text)
+        self.assertIn('email_insert_seconds_bucket{le="+Inf"} 2', text)
+
+        for path in ('metrics_test.prom', 'metrics_test.jsonl'):
+            self.addCleanup(os.remove, path)
+            client.metrics.export(path, "fetch", summary)
+        client.metrics.export('metrics_test.jsonl', "rules", summary)
+        with open('metrics_test.prom') as file:
+            self.assertEqual(file.read(), text)
+        with open('metrics_test.jsonl') as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual([record['run'] for record in records], ["fetch", "rules"])
+        self.assertEqual(records[0]['counters']['api_calls,method=messages.get'], 4)
+
+        self.assertFalse(any(metrics.LogSampler().sample() for _ in range(10)))
+        sampler = metrics.LogSampler(every=3)
+        self.assertEqual([sampler.sample() for _ in range(6)], [True, False, False, True, False, False])
+
+#####################################
+# Unit Tests for rule_engine.py
+#####################################
+class TestRuleEngine(unittest.TestCase):
+
+    def test_aho_corasick_finds_overlapping_patterns(self):
+        """
+        Unit Test:
+        - Every pattern occurring in the text is reported, including overlapping ones.
+        """
+        matcher = rule_engine.AhoCorasick({'he': ['he'], 'she': ['she'], 'hers': ['hers'], 'x': ['x']})
+        self.assertEqual(matcher.search('ushers'), {'he', 'she', 'hers'})
+
+    def test_compiled_rules_match_all_rules_in_one_pass(self):
+        """
+        Unit Test:
+        - contains and equals conditions are matched case-insensitively per field.
+        - "All" rules need every condition, "Any" rules need one.
+        """
+        compiled = rule_engine.compile_rules({"rules": [
+            {"predicate": "All", "conditions": [{"field": "from", "operator": "contains", "value": "News"}],
+             "actions": ["mark_as_read"]},
+            {"predicate": "All", "conditions": [
+                {"field": "from", "operator": "contains", "value": "news"},
+                {"field": "subject", "operator": "equals", "value": "weekly digest"}], "actions": ["add_star"]},
+            {"predicate": "Any", "conditions": [
+                {"field": "from", "operator": "equals", "value": "boss@example.com"},
+                {"field": "subject", "operator": "contains", "value": "urgent"}], "actions": ["add_star"]},
+        ]})
+        self.assertEqual(compiled.fields, ['from', 'subject'])
+        self.assertEqual(compiled.match({'from': 'news@shop.com', 'subject': 'Weekly Digest'}), [0, 1])
+        self.assertEqual(compiled.match({'from': 'news@shop.com', 'subject': 'Sale'}), [0])
+        self.assertEqual(compiled.match({'from': 'Boss@Example.com', 'subject': ''}), [2])
+        self.assertEqual(compiled.match({'from': 'me@example.com', 'subject': None}), [])
+
+    def test_compiled_rules_negation_and_dates_in_batches(self):
+        """
+        Unit Test:
+        - does_not_contain / does_not_equal hold when the value is absent.
+        - received_at conditions compare against day ages and calendar dates.
+        - match_batch evaluates a whole column batch at once.
+        """
+        now = 1_700_000_000
+        day = 86400 * 1000
+        compiled = rule_engine.compile_rules({"rules": [
+            {"predicate": "All", "conditions": [
+                {"field": "from", "operator": "contains", "value": "shop"},
+                {"field": "subject", "operator": "does_not_contain", "value": "receipt"},
+                {"field": "received_at", "operator": "greater_than", "value": "7 days"}], "actions": []},
+            {"predicate": "Any", "conditions": [
+                {"field": "message", "operator": "does_not_equal", "value": ""},
+                {"field": "received_at", "operator": "after", "value": "2023-11-14"}], "actions": []},
+        ]}, now=now)
+        columns = {
+            'from': ['shop@a.com', 'shop@a.com', 'friend@b.com'],
+            'subject': ['Sale', 'Your receipt', 'Hi'],
+            'message': ['', '', 'hello'],
+            'received_at': [str(now * 1000 - 10 * day), str(now * 1000 - 10 * day), str(now * 1000)],
+        }
+        self.assertEqual(compiled.match_batch(columns, 3), [[0], [], [1]])
+        with self.assertRaises(ValueError):
+            rule_engine.compile_rules({"rules": [{"predicate": "All", "conditions": [
+                {"field": "from", "operator": "matches", "value": "x"}]}]})
+
+    def test_rule_to_sql_matches_python_evaluator(self):
+        """
+        Unit Test:
+        - Rules pushed down to SQLite select the same unread emails as the compiled matcher,
+          including date thresholds and timestamps from before 2001 (fewer than 13 digits).
+        """
+        now = 1_700_000_000
+        day = 86400 * 1000
+        rules_data = {"rules": [
+            {"predicate": "All", "conditions": [
+                {"field": "from", "operator": "contains", "value": "SHOP"},
+                {"field": "subject", "operator": "does_not_contain", "value": "receipt"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "from", "operator": "equals", "value": "Friend@B.com"},
+                {"field": "received_at", "operator": "less_than", "value": "3"}]},
+            {"predicate": "All", "conditions": [
+                {"field": "message", "operator": "does_not_equal", "value": ""},
+                {"field": "received_at", "operator": "before", "value": "2023-11-10"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "received_at", "operator": "before", "value": "1999-01-01"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "received_at", "operator": "after", "value": "1996-01-01"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "received_at", "operator": "greater_than", "value": "10000"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "received_at", "operator": "less_than", "value": "-200000"}]},
+            {"predicate": "Any", "conditions": []},
+        ]}
+        store = storage.EmailStore(':memory:', fts=True)
+        store.insert_emails([
+            ('1', 'shop@a.com', 'Sale', str(now * 1000 - 10 * day), '', 0),
+            ('2', 'shop@a.com', 'Your receipt', str(now * 1000 - day), 'paid', 0),
+            ('3', 'friend@b.com', None, '', None, 0),
+            ('4', 'shop@a.com', 'Sale', str(now * 1000), 'read already', 1),
+            ('5', 'old@c.com', 'Old', '900000000000', '', 0),
+            ('6', 'old@c.com', 'Older', '800000000000', '', 0),
+        ])
+        store.flush()
+        compiled = rule_engine.compile_rules(rules_data, now=now)
+        rows = list(store.iter_unread(('id', 'sender', 'subject', 'message', 'received_at')))
+        columns = dict(zip(['from', 'subject', 'message', 'received_at'], list(zip(*rows))[1:]))
+        python_matches = compiled.match_batch(columns, len(rows))
+        for rule_index, rule in enumerate(rules_data["rules"]):
+            expected = [row[0] for row, matched in zip(rows, python_matches) if rule_index in matched]
+            for fts in (False, True):
+                with self.subTest(rule=rule_index, fts=fts):
+                    where, params = rule_engine.rule_to_sql(rule, now=now, fts=fts)
+                    self.assertEqual(sorted(store.iter_unread_matching(where, params)), expected)
+        store.close()
+
+    def test_parallel_matching_equals_serial(self):
+        """
+        Unit Test:
+        - Evaluating rowid ranges in worker processes yields the same matches, in the same
+          order, as the serial evaluator.
+        """
+        rules_data = {"rules": [
+            {"predicate": "All", "conditions": [{"field": "from", "operator": "contains", "value": "shop"}]},
+            {"predicate": "Any", "conditions": [
+                {"field": "subject", "operator": "equals", "value": "hello"},
+                {"field": "received_at", "operator": "greater_than", "value": "1"}]},
+        ]}
+        now = 1_700_000_000
+        with tempfile.TemporaryDirectory() as directory:
+            db_path = os.path.join(directory, 'emails.db')
+            store = storage.EmailStore(db_path)
+            store.insert_emails([
+                (str(index), f'{"shop" if index % 3 else "friend"}@example.com', 'Hello' if index % 5 else 'Hi',
+                 str(now * 1000 - index * 3600 * 1000), '', index % 7 == 0)
+                for index in range(300)
+            ])
+            store.flush()
+            compiled = rule_engine.compile_rules(rules_data, now=now)
+            serial = list(rules.match_unread(store, compiled))
+            parallel = list(rules.match_unread_parallel(store, db_path, rules_data, 2, now))
+            store.close()
+        self.assertTrue(serial)
+        self.assertEqual(parallel, serial)
+
+#####################################
+# Unit Tests for rule_store.py
+#####################################
+class TestRuleStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'rules.json')
+        self.cache_patcher = patch('rule_store.cache_dir', return_value=os.path.join(self.directory.name, 'cache'))
+        self.cache_patcher.start()
+        self.rule = {"predicate": "All", "conditions": [{"field": "from", "operator": "contains", "value": "shop"}],
+                     "actions": ["mark_as_read"]}
+
+    def tearDown(self):
+        self.cache_patcher.stop()
+        self.directory.cleanup()
+
+    def test_rule_store_reloads_and_compiles_only_on_change(self):
+        """
+        Unit Test:
+        - Rules are parsed and compiled once, and a new store reuses the pickled matcher.
+        - Batched additions are written atomically and picked up without re-reading the file.
+        - Editing rules.json on disk is detected and recompiled.
+        """
+        store = rule_store.RuleStore(self.path)
+        store.add_rules([self.rule, self.rule])
+        self.assertEqual(os.listdir(self.directory.name), ['rules.json'])
+        self.assertEqual(os.path.dirname(store.cache_path), os.path.join(self.directory.name, 'cache'))
+        with patch('rule_store.compile_rules', wraps=rule_engine.compile_rules) as compile_rules:
+            compiled = store.compiled()
+            self.assertIs(store.compiled(), compiled)
+            self.assertEqual(compiled.match({'from': 'shop@example.com'}), [0, 1])
+            self.assertEqual(rule_store.RuleStore(self.path).compiled().match({'from': 'shop'}), [0, 1])
+            self.assertEqual(compile_rules.call_count, 1)
+            self.assertEqual(sorted(os.listdir(self.directory.name)), ['cache', 'rules.json'])
+
+            with patch('builtins.open', side_effect=AssertionError("rules.json re-read")):
+                self.assertEqual(len(store.load()["rules"]), 2)
+
+            with open(self.path, 'w') as file:
+                json.dump({"rules": [self.rule]}, file)
+            self.assertEqual(store.compiled().match({'from': 'shop'}), [0])
+            self.assertEqual(compile_rules.call_count, 2)
+
+#####################################
+# Integration Test for daemon.py
+#####################################
+class TestDaemon(unittest.TestCase):
+
+    def test_cycles_apply_rules_to_newly_fetched_emails_only(self):
+        """
+        Integration Test for the daemon loop:
+        - One store and client are reused by every cycle's fetch and apply_rules.
+        - apply_rules only sees the emails stored during the cycle, and is skipped when
+          nothing new arrived.
+        - Per-cycle stats are recorded, and stop() ends the loop after the current cycle.
+        """
+        store = storage.EmailStore(':memory:')
+        deliveries = [[('a', 'x@example.com', 'One', '2024-01-01', 'Body', 0),
+                       ('b', 'x@example.com', 'Two', '2024-01-01', 'Body', 0)], [],
+                      [('c', 'x@example.com', 'Three', '2024-01-02', 'Body', 0)]]
+        compiled = rule_engine.compile_rules({"rules": [{"predicate": "All", "conditions": [
+            {"field": "from", "operator": "contains", "value": "x@"}], "actions": ["mark_as_read"]}]})
+        matched = []
+        runner = daemon.Daemon(interval=0, jitter=0, log_callback=lambda msg: None)
+
+        def fetch_emails(*args, **kwargs):
+            kwargs['store'].insert_emails(deliveries[runner.cycles - 1])
+
+        def apply_rules(*args, **kwargs):
+            self.assertIs(kwargs['client'], runner.client)
+            matched.append(sorted(email_id for email_id, _ in
+                                  rules.match_unread(kwargs['store'], compiled, kwargs['after_rowid'])))
+            if runner.cycles == 3:
+                runner.stop()
+
+        with patch('daemon.EmailStore', return_value=store), patch('daemon.authenticate'), \
+                patch('daemon.http_pool'), patch('daemon.fetch_emails', side_effect=fetch_emails) as fetch_call, \
+                patch('daemon.apply_rules', side_effect=apply_rules), patch.object(store, 'close'):
+            runner.run(max_cycles=10)
+
+        self.assertEqual(runner.cycles, 3)
+        self.assertTrue(all(call.kwargs['store'] is store for call in fetch_call.call_args_list))
+        self.assertEqual(matched, [['a', 'b'], ['c']])
+        self.assertEqual([stats['new_emails'] for stats in runner.history], [2, 0, 1])
+        self.assertEqual(runner.history[1]['rules_seconds'], 0.0)
+        self.assertIsNone(runner.history[2]['error'])
+        store.conn.close()
+
+    def test_stop_cancels_the_running_fetch_and_defers_its_rules(self):
+        """
+        Integration Test for stopping mid-cycle:
+        - stop() during a fetch reaches it through `cancel`, so the cycle ends at the fetch's
+          next chunk, and the fetch is asked to resume from its checkpoint.
+        - Rules are skipped for that cycle, and the next daemon evaluates the emails it stored.
+        """
+        store = storage.EmailStore(':memory:')
+        compiled = rule_engine.compile_rules({"rules": [{"predicate": "All", "conditions": [
+            {"field": "from", "operator": "contains", "value": "x@"}], "actions": ["mark_as_read"]}]})
+        fetch_calls = []
+        applied = []
+        runner = daemon.Daemon(interval=0, jitter=0, log_callback=lambda msg: None)
+
+        def fetch_emails(*args, **kwargs):
+            fetch_calls.append(kwargs)
+            for email_id in ('a', 'b'):
+                # Each email stands for a chunk; cancel is checked before every one.
+                if kwargs['cancel'].is_set():
+                    return
+                kwargs['store'].insert_emails([(email_id, 'x@example.com', 'Sale', '', 'Body', 0)])
+                if runner is first:
+                    runner.stop()
+
+        def apply_rules(*args, **kwargs):
+            applied.append(sorted(email_id for email_id, _ in
+                                  rules.match_unread(kwargs['store'], compiled, kwargs['after_rowid'])))
+
+        first = runner
+        with patch('daemon.EmailStore', return_value=store), patch('daemon.authenticate'), \
+                patch('daemon.http_pool'), patch('daemon.fetch_emails', side_effect=fetch_emails), \
+                patch('daemon.apply_rules', side_effect=apply_rules), patch.object(store, 'close'):
+            runner.run(max_cycles=10)
+            self.assertEqual(runner.cycles, 1)
+            self.assertIs(fetch_calls[0]['cancel'], runner.stopping)
+            self.assertTrue(fetch_calls[0]['resume'])
+            self.assertEqual(applied, [])
+            self.assertEqual(store.max_rowid(), 1)
+
+            runner = daemon.Daemon(interval=0, jitter=0, log_callback=lambda msg: None)
+            runner.run(max_cycles=1)
+        self.assertEqual(applied, [['a', 'b']])
+        self.assertIsNone(store.get_state(daemon.RULES_PENDING_KEY))
+        store.conn.close()
+
 #####################################
 # Unit and Integration Tests for rules.py
 #####################################
@@ -150,14 +1135,19 @@ class TestRules(unittest.TestCase):
             os.remove(self.original_rules_path)
         os.rename(self.test_rules_path, self.original_rules_path)
 
-        # Patch sqlite3.connect in rules.py to use our in-memory DB.
-        self.sqlite_patcher = patch('rules.sqlite3.connect', lambda db_name="emails.db": self.conn)
+        # Keep compiled rule caches out of the user's cache directory.
+        self.cache_directory = tempfile.TemporaryDirectory()
+        self.cache_patcher = patch('rule_store.cache_dir', return_value=self.cache_directory.name)
+        self.cache_patcher.start()
+
+        # Patch sqlite3.connect in the storage layer to use our in-memory DB.
+        self.sqlite_patcher = patch('storage.sqlite3.connect', lambda db_name="emails.db": self.conn)
         self.sqlite_patcher.start()
 
         # Create a fake Gmail API service for rules.py.
         self.fake_service = MagicMock()
-        # Simulate a successful modify() call for mark_as_read.
-        self.fake_service.users.return_value.messages.return_value.modify.return_value.execute.return_value = {}
+        # Simulate a successful batchModify() call for mark_as_read.
+        self.fake_service.users.return_value.messages.return_value.batchModify.return_value.execute.return_value = {}
 
         # Patch rules.authenticate and rules.build so that apply_rules() uses our fake service.
         self.auth_patcher = patch('rules.authenticate', return_value=MagicMock())
@@ -169,6 +1159,8 @@ class TestRules(unittest.TestCase):
         self.sqlite_patcher.stop()
         self.auth_patcher.stop()
         self.build_patcher.stop()
+        self.cache_patcher.stop()
+        self.cache_directory.cleanup()
         self.conn.close()
         if os.path.exists('rules.json'):
             os.remove('rules.json')
@@ -188,14 +1180,166 @@ class TestRules(unittest.TestCase):
         Integration Test:
         - Inserts a dummy unread email.
         - Adds a rule for marking emails as read.
-        - Calls apply_rules(), which should trigger the Gmail API modify() call.
-        - Verifies that modify() is called with the expected parameters.
+        - Calls apply_rules(), which should trigger the Gmail API batchModify() call.
+        - Verifies that batchModify() is called with the expected parameters.
         """
         rules.update_rules('test@example.com', 'mark_as_read')
         rules.apply_rules()
-        self.fake_service.users.return_value.messages.return_value.modify.assert_called_with(
-            userId='me', id='1', body={"removeLabelIds": ["UNREAD"]}
+        self.fake_service.users.return_value.messages.return_value.batchModify.assert_called_with(
+            userId='me', body={"ids": ['1'], "removeLabelIds": ["UNREAD"]}
+        )
+
+    def test_apply_rules_sql_pushdown(self):
+        """
+        Integration Test:
+        - With sql_pushdown=True, matching ids come from SQLite and actions are still applied.
+        """
+        rules.update_rules('TEST@example.com', 'mark_as_read')
+        rules.apply_rules(log_callback=lambda msg: None, sql_pushdown=True)
+        self.fake_service.users.return_value.messages.return_value.batchModify.assert_called_with(
+            userId='me', body={"ids": ['1'], "removeLabelIds": ["UNREAD"]}
+        )
+
+    def test_apply_rules_honors_field_and_predicate(self):
+        """
+        Integration Test:
+        - A rule whose subject condition does not match is not applied, even if the sender matches.
+        """
+        rules.add_rule("All", [
+            {"field": "from", "operator": "contains", "value": "test@example.com"},
+            {"field": "subject", "operator": "equals", "value": "Invoice"},
+        ], ["mark_as_read"], log_callback=lambda msg: None)
+        rules.apply_rules(log_callback=lambda msg: None)
+        self.fake_service.users.return_value.messages.return_value.batchModify.assert_not_called()
+
+    def test_apply_rules_hydrates_message_bodies(self):
+        """
+        Integration Test:
+        - An email stored without a body is downloaded before a rule on the message field is evaluated.
+        """
+        self.cursor.execute("UPDATE emails SET message = NULL WHERE id = '1'")
+        self.conn.commit()
+        messages_api = self.fake_service.users.return_value.messages.return_value
+        message = {'id': '1', 'payload': {'body': {'data': base64.urlsafe_b64encode(b'Quarterly invoice').decode()}}}
+        batches = []
+
+        def new_batch(callback):
+            batches.append(FakeBatch(callback, {'1': [message]}))
+            return batches[-1]
+
+        self.fake_service.new_batch_http_request.side_effect = new_batch
+        rules.add_rule("All", [{"field": "message", "operator": "contains", "value": "invoice"}],
+                       ["mark_as_read"], log_callback=lambda msg: None)
+        rules.apply_rules(log_callback=lambda msg: None)
+        messages_api.get.assert_called_once_with(userId='me', id='1')
+        self.assertEqual([batch.request_ids for batch in batches], [['1']])
+        messages_api.batchModify.assert_called_with(
+            userId='me', body={"ids": ['1'], "removeLabelIds": ["UNREAD"]}
         )
 
+    def test_label_cache_resolves_once_and_creates_missing(self):
+        """
+        Unit Test:
+        - Labels are listed once and looked up case-insensitively.
+        - With create_missing, a label that does not exist is created.
+        - A second cache on the same store reuses the persisted labels within the TTL,
+          and reloads them from Gmail once when a lookup misses.
+        """
+        labels_api = self.fake_service.users.return_value.labels.return_value
+        labels_api.list.return_value.execute.return_value = {'labels': [{'id': 'Label_1', 'name': 'Work'}]}
+        labels_api.create.return_value.execute.return_value = {'id': 'Label_2', 'name': 'Later'}
+        store = storage.EmailStore(':memory:')
+
+        cache = rules.LabelCache(self.fake_service, store, create_missing=True, log_callback=lambda msg: None)
+        self.assertEqual(cache.get_id('work'), 'Label_1')
+        self.assertEqual(cache.get_id('WORK'), 'Label_1')
+        self.assertEqual(cache.get_id('Later'), 'Label_2')
+        self.assertEqual(labels_api.list.call_count, 1)
+        labels_api.create.assert_called_once()
+
+        warm = rules.LabelCache(self.fake_service, store)
+        self.assertEqual(warm.get_id('later'), 'Label_2')
+        self.assertEqual(labels_api.list.call_count, 1)
+        self.assertIsNone(warm.get_id('Missing'))
+        self.assertIsNone(warm.get_id('Missing'))
+        self.assertEqual(labels_api.list.call_count, 2)
+        store.close()
+
+    def test_action_batch_merges_and_chunks(self):
+        """
+        Unit Test:
+        - Conflicting and duplicate actions are merged per email, later actions winning.
+        - Emails with the same delta share batchModify calls of at most 1,000 ids.
+        - Emails marked read are updated in the local emails table.
+        """
+        batch = rules.ActionBatch()
+        for index in range(1001):
+            batch.add(str(index), ["mark_as_read", "add_star", "add_star"])
+        batch.add('x', ["mark_as_read"])
+        batch.add('x', ["mark_as_unread"])
+        store = storage.EmailStore(':memory:')
+        results = batch.flush(self.fake_service, store, log_callback=lambda msg: None)
+
+        calls = self.fake_service.users.return_value.messages.return_value.batchModify.call_args_list
+        bodies = [call.kwargs['body'] for call in calls]
+        self.assertEqual([len(body['ids']) for body in bodies], [1000, 1, 1])
+        self.assertEqual(bodies[0]['addLabelIds'], ['STARRED'])
+        self.assertEqual(bodies[0]['removeLabelIds'], ['UNREAD'])
+        self.assertEqual(bodies[2], {'ids': ['x'], 'addLabelIds': ['UNREAD']})
+        self.assertTrue(all(error is None for _, _, _, error in results))
+        store.cursor.execute("SELECT is_read FROM emails WHERE id='1'")
+        self.assertEqual(store.cursor.fetchone()[0], 1)
+        store.close()
+
+    def test_action_batch_journals_applied_actions(self):
+        """
+        Unit Test:
+        - Sent actions are journaled with the local is_read update, and not sent again.
+        - A new rule, or an action on a label that does not exist, is still applied later.
+        """
+        labels_api = self.fake_service.users.return_value.labels.return_value
+        labels_api.list.return_value.execute.return_value = {'labels': []}
+        batch_modify = self.fake_service.users.return_value.messages.return_value.batchModify
+        store = storage.EmailStore(':memory:')
+        store.insert_emails([('1', 'a@example.com', '', '', '', 0)])
+        log = lambda msg: None
+
+        batch = rules.ActionBatch()
+        batch.add('1', ["mark_as_read", "move_to_label:Later"], 'rule-a')
+        batch.flush(self.fake_service, store, log)
+        self.assertEqual(batch_modify.call_count, 1)
+        self.assertEqual(store.applied_actions(['1']), {('1', 'rule-a', 'mark_as_read')})
+        store.cursor.execute("SELECT is_read FROM emails WHERE id='1'")
+        self.assertEqual(store.cursor.fetchone()[0], 1)
+
+        batch.add('1', ["mark_as_read"], 'rule-a')
+        self.assertEqual(batch.flush(self.fake_service, store, log), [])
+        self.assertEqual(batch_modify.call_count, 1)
+        batch.add('1', ["mark_as_read"], 'rule-b')
+        batch.flush(self.fake_service, store, log)
+        self.assertEqual(batch_modify.call_count, 2)
+        store.close()
+
+    def test_action_batch_stops_when_cancelled(self):
+        """
+        Unit Test:
+        - Once the cancel event is set, no further chunks are sent, and every chunk sent
+          is journaled.
+        """
+        batch_modify = self.fake_service.users.return_value.messages.return_value.batchModify
+        store = storage.EmailStore(':memory:')
+        cancel = threading.Event()
+        batch_modify.side_effect = lambda **kwargs: (cancel.set(), MagicMock())[1]
+        batch = rules.ActionBatch()
+        for index in range(1001):
+            batch.add(str(index), ["mark_as_read"], 'rule-a')
+
+        results = batch.flush(self.fake_service, store, lambda msg: None, cancel=cancel)
+
+        self.assertEqual(batch_modify.call_count, 1)
+        self.assertEqual([len(ids) for ids, _, _, _ in results], [1000])
+        self.assertEqual(len(store.applied_actions([str(index) for index in range(1001)])), 1000)
+        store.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,31 @@
 import os
 import pickle
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+TOKEN_FILE = 'token.pickle'
+
+def save_token(creds):
+    """
+    Saves the credentials for the next run.
+    """
+    with open(TOKEN_FILE, 'wb') as token:
+        pickle.dump(creds, token)
 
 def authenticate(credentials_file="credentials.json"):
     creds = None
     # Load token from file if it exists.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'rb') as token:
             creds = pickle.load(token)
     # If no valid credentials are available, let the user log in.
     if not creds or not creds.valid:
+        # The Google auth libraries are slow to import, so they are only loaded when needed.
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
             creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run.
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        save_token(creds)
     return creds
@@ -0,0 +1,70 @@
+"""
+Benchmarks payload.extract_body against the original top-level body loop of
+fetch.parse_message on large synthetic payloads.
+
+    python benchmarks/bench_payload.py [parts] [part_kb]
+"""
+import base64
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payload import extract_body
+
+def legacy_body(payload):
+    """
+    The body loop fetch.parse_message used before payload.py: top-level parts only,
+    concatenated with +=.
+    """
+    message_body = ''
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part.get('mimeType') == 'text/plain':
+                data = part['body'].get('data', '')
+                if data:
+                    decoded = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
+                    message_body += decoded
+    else:
+        body_data = payload.get('body', {}).get('data', '')
+        if body_data:
+            message_body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
+    return message_body
+
+def make_part(index, part_kb):
+    text = (f'Part {index}: ' + 'lorem ipsum dolor sit amet ' * 40)[:1024] * part_kb
+    return {'mimeType': 'text/plain', 'body': {'data': base64.urlsafe_b64encode(text.encode()).decode()}}
+
+def flat_payload(parts, part_kb):
+    return {'mimeType': 'multipart/mixed', 'parts': [make_part(index, part_kb) for index in range(parts)]}
+
+def nested_payload(parts, part_kb):
+    """
+    The same parts, each wrapped in its own multipart/alternative with an HTML twin.
+    """
+    html = {'mimeType': 'text/html', 'body': {'data': base64.urlsafe_b64encode(b'<p>html</p>').decode()}}
+    return {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'multipart/alternative', 'parts': [make_part(index, part_kb), html]}
+        for index in range(parts)
+    ]}
+
+def bench(label, function, repeat=5):
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    print(f"{label:<40} {best * 1000:9.2f} ms")
+    return best
+
+def main(parts=2000, part_kb=4):
+    flat = flat_payload(parts, part_kb)
+    nested = nested_payload(parts, part_kb)
+    print(f"{parts} parts of {part_kb} KiB")
+    bench("legacy loop, flat", lambda: legacy_body(flat))
+    bench("extract_body, flat", lambda: extract_body(flat))
+    bench("extract_body, flat, max_chars=64k", lambda: extract_body(flat, max_chars=65536))
+    bench("extract_body, nested", lambda: extract_body(nested))
+    # The legacy loop finds no top-level text/plain parts in the nested tree.
+    assert legacy_body(nested) == ''
+    assert extract_body(flat) == legacy_body(flat) == extract_body(nested)
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
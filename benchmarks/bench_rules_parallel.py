@@ -0,0 +1,68 @@
+"""
+Benchmarks serial against process-pool rule evaluation (rules.match_unread and
+rules.match_unread_parallel) on a synthetic database of unread emails.
+
+    python benchmarks/bench_rules_parallel.py [rows] [max_workers]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rule_engine import compile_rules
+from rules import match_unread, match_unread_parallel
+from storage import EmailStore
+
+WORDS = ['invoice', 'meeting', 'newsletter', 'sale', 'receipt', 'report', 'hello', 'update', 'offer', 'alert']
+
+def make_rules(count=50):
+    rng = random.Random(1)
+    return {"rules": [
+        {"predicate": "All", "conditions": [
+            {"field": "from", "operator": "contains", "value": f"sender{rng.randrange(500)}@"},
+            {"field": "subject", "operator": "contains", "value": rng.choice(WORDS)},
+            {"field": "message", "operator": "does_not_contain", "value": rng.choice(WORDS) + " " + rng.choice(WORDS)},
+        ], "actions": ["mark_as_read"]}
+        for _ in range(count)
+    ]}
+
+def fill(store, rows):
+    rng = random.Random(2)
+    now_ms = int(time.time() * 1000)
+    for start in range(0, rows, 10000):
+        store.insert_emails([
+            (f'id{index}', f'sender{rng.randrange(2000)}@example.com', ' '.join(rng.choices(WORDS, k=4)),
+             str(now_ms - rng.randrange(86400000 * 30)), ' '.join(rng.choices(WORDS, k=60)), 0)
+            for index in range(start, min(rows, start + 10000))
+        ])
+    store.flush()
+
+def main(rows=200000, max_workers=os.cpu_count() or 1):
+    rules_data = make_rules()
+    now = time.time()
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'emails.db')
+        store = EmailStore(db_path)
+        fill(store, rows)
+        print(f"{rows} unread emails, {len(rules_data['rules'])} rules, {os.cpu_count()} CPUs")
+
+        started = time.perf_counter()
+        serial = list(match_unread(store, compile_rules(rules_data, now=now)))
+        baseline = time.perf_counter() - started
+        print(f"{'serial':<12} {baseline:8.2f} s  {len(serial)} matches")
+
+        workers = 2
+        while workers <= max_workers:
+            started = time.perf_counter()
+            parallel = list(match_unread_parallel(store, db_path, rules_data, workers, now))
+            elapsed = time.perf_counter() - started
+            assert parallel == serial
+            print(f"{workers:>2} workers   {elapsed:8.2f} s  {baseline / elapsed:.2f}x")
+            workers *= 2
+        store.close()
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,250 @@
+"""
+In-process stand-in for the googleapiclient Gmail service, for benchmarks.
+
+FakeGmail generates a mailbox of synthetic messages and answers the calls the app makes:
+users().messages().list/get/batchModify, users().history().list, users().getProfile,
+users().labels().list/create and new_batch_http_request. Each HTTP round trip sleeps
+`latency` seconds, and any call can fail with a 429 with probability `error_rate`.
+`calls` counts quota-level API calls per method and `http_requests` counts round trips
+(a batch of 100 gets is 100 calls but one request). List calls return at most
+MAX_PAGE_SIZE results per page, like Gmail.
+"""
+import base64
+import random
+import threading
+import time
+from collections import Counter
+import httplib2
+from googleapiclient.errors import HttpError
+
+WORDS = ('invoice meeting update report sale offer weekly newsletter receipt order shipped account security '
+         'alert reminder project review lunch team quarterly budget travel booking confirmation welcome').split()
+# Gmail caps maxResults of messages().list and history().list at 500.
+MAX_PAGE_SIZE = 500
+DOMAINS = ('example.com', 'shop.example', 'news.example.org', 'corp.example.net', 'mail.example.io')
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+class _Request:
+    """
+    A request object with googleapiclient's execute(http=None) interface.
+    """
+
+    def __init__(self, fake, method, handler):
+        self.fake = fake
+        self.method = method
+        self.handler = handler
+
+    def execute(self, http=None, num_retries=0):
+        self.fake._round_trip()
+        return self.fake._call(self.method, self.handler)
+
+class _Batch:
+    """
+    Stand-in for BatchHttpRequest: one round trip, one callback per added request.
+    """
+
+    def __init__(self, fake, callback):
+        self.fake = fake
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request, request_id or str(len(self.requests)), callback or self.callback))
+
+    def execute(self, http=None):
+        self.fake._round_trip()
+        for request, request_id, callback in self.requests:
+            try:
+                response = self.fake._call(request.method, request.handler)
+            except HttpError as error:
+                callback(request_id, None, error)
+            else:
+                callback(request_id, response, None)
+
+class _Resource:
+    """
+    Attribute bag standing in for a googleapiclient resource.
+    """
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+class FakeGmail:
+    """
+    Synthetic mailbox of `messages` messages. Sizes and structure are drawn from a seeded
+    RNG: senders follow a skewed distribution over a few hundred addresses, bodies have a
+    log-normal size (median about 2 KB), and parts are a mix of single text/plain,
+    multipart/alternative (plain and HTML) and multipart/mixed with an attachment.
+    """
+
+    def __init__(self, messages=1000, latency=0.0, error_rate=0.0, unread_ratio=0.6, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.http_requests = 0
+        self.errors = 0
+        self.labels = [{'id': 'INBOX', 'name': 'INBOX'}, {'id': 'UNREAD', 'name': 'UNREAD'},
+                       {'id': 'STARRED', 'name': 'STARRED'}]
+        senders = [f'{self.rng.choice(WORDS)}{index}@{self.rng.choice(DOMAINS)}' for index in range(300)]
+        weights = [1 / (rank + 1) for rank in range(len(senders))]
+        now_ms = int(time.time() * 1000)
+        self.messages = {}
+        self.order = []
+        for index in range(messages):
+            msg_id = f'{index:016x}'
+            labels = ['INBOX'] + (['UNREAD'] if self.rng.random() < unread_ratio else [])
+            self.messages[msg_id] = self._make_message(
+                msg_id, self.rng.choices(senders, weights)[0], now_ms - self.rng.randrange(60 * 86400 * 1000),
+                labels, index + 1)
+            self.order.append(msg_id)
+        # Newest first, like Gmail.
+        self.order.reverse()
+        self.history_id = messages
+
+    def _make_message(self, msg_id, sender, internal_date, labels, history_id):
+        rng = self.rng
+        subject = ' '.join(rng.choices(WORDS, k=rng.randint(3, 10))).capitalize()
+        size = min(200_000, int(rng.lognormvariate(7.6, 1.0)))
+        text = ' '.join(rng.choices(WORDS, k=max(1, size // 7)))
+        headers = [
+            {'name': 'From', 'value': sender},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(internal_date / 1000))},
+            {'name': 'To', 'value': 'me@example.com'},
+        ]
+        plain = {'mimeType': 'text/plain', 'filename': '', 'body': {'size': len(text), 'data': _encode(text)},
+                 'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="UTF-8"'}]}
+        shape = rng.random()
+        if shape < 0.4:
+            payload = dict(plain, headers=headers + plain['headers'])
+        else:
+            html = f'<html><body><p>{text}</p></body></html>'
+            alternative = {'mimeType': 'multipart/alternative', 'filename': '', 'body': {'size': 0}, 'parts': [
+                plain,
+                {'mimeType': 'text/html', 'filename': '', 'body': {'size': len(html), 'data': _encode(html)},
+                 'headers': [{'name': 'Content-Type', 'value': 'text/html; charset="UTF-8"'}]},
+            ]}
+            if shape < 0.8:
+                payload = dict(alternative, headers=headers)
+            else:
+                attachment = {'mimeType': 'application/pdf', 'filename': 'document.pdf',
+                              'body': {'size': 50_000, 'attachmentId': f'att-{msg_id}'}}
+                payload = {'mimeType': 'multipart/mixed', 'filename': '', 'headers': headers, 'body': {'size': 0},
+                           'parts': [alternative, attachment]}
+        return {'id': msg_id, 'threadId': msg_id, 'labelIds': labels, 'snippet': text[:100],
+                'historyId': str(history_id), 'internalDate': str(internal_date), 'payload': payload,
+                'sizeEstimate': size}
+
+    def deliver(self, count):
+        """
+        Adds `count` new messages to the mailbox, visible to list and history.
+        """
+        now_ms = int(time.time() * 1000)
+        senders = [message['payload']['headers'][0]['value'] for message in list(self.messages.values())[:50]]
+        for _ in range(count):
+            self.history_id += 1
+            msg_id = f'{len(self.messages):016x}'
+            self.messages[msg_id] = self._make_message(
+                msg_id, self.rng.choice(senders), now_ms, ['INBOX', 'UNREAD'], self.history_id)
+            self.order.insert(0, msg_id)
+
+    def _round_trip(self):
+        with self.lock:
+            self.http_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _call(self, method, handler):
+        with self.lock:
+            self.calls[method] += 1
+            failed = self.error_rate and self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            response = httplib2.Response({'status': 429, 'retry-after': '0'})
+            raise HttpError(response, b'{"error": {"code": 429, "message": "rateLimitExceeded"}}')
+        return handler()
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = Counter()
+            self.http_requests = 0
+            self.errors = 0
+
+    # googleapiclient surface -------------------------------------------------------------
+
+    def users(self):
+        return _Resource(
+            messages=lambda: _Resource(list=self._list, get=self._get, batchModify=self._batch_modify),
+            history=lambda: _Resource(list=self._history),
+            labels=lambda: _Resource(list=self._labels_list, create=self._labels_create),
+            getProfile=lambda userId: _Request(self, 'getProfile', lambda: {
+                'emailAddress': 'me@example.com', 'historyId': str(self.history_id)}),
+        )
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+    def _list(self, userId, q=None, maxResults=100, pageToken=None, **params):
+        maxResults = min(maxResults, MAX_PAGE_SIZE)
+
+        def handler():
+            start = int(pageToken or 0)
+            ids = self.order[start:start + maxResults]
+            response = {'messages': [{'id': msg_id, 'threadId': msg_id} for msg_id in ids],
+                        'resultSizeEstimate': len(self.order)}
+            if start + maxResults < len(self.order):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return _Request(self, 'messages.list', handler)
+
+    def _get(self, userId, id, format='full', metadataHeaders=None):
+        def handler():
+            message = self.messages.get(id)
+            if message is None:
+                raise HttpError(httplib2.Response({'status': 404}), b'Not Found')
+            if format != 'metadata':
+                return message
+            names = set(metadataHeaders or ())
+            headers = [header for header in message['payload']['headers'] if not names or header['name'] in names]
+            return {**message, 'payload': {'mimeType': message['payload']['mimeType'], 'headers': headers}}
+        return _Request(self, 'messages.get', handler)
+
+    def _batch_modify(self, userId, body):
+        def handler():
+            for msg_id in body['ids']:
+                labels = self.messages[msg_id]['labelIds']
+                labels[:] = [label for label in labels if label not in body.get('removeLabelIds', [])]
+                labels.extend(label for label in body.get('addLabelIds', []) if label not in labels)
+            return {}
+        return _Request(self, 'messages.batchModify', handler)
+
+    def _history(self, userId, startHistoryId, historyTypes=None, maxResults=100, pageToken=None, **params):
+        maxResults = min(maxResults, MAX_PAGE_SIZE)
+
+        def handler():
+            added = [msg_id for msg_id in reversed(self.order)
+                     if int(self.messages[msg_id]['historyId']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            records = [{'id': self.messages[msg_id]['historyId'],
+                        'messagesAdded': [{'message': {'id': msg_id, 'labelIds': self.messages[msg_id]['labelIds']}}]}
+                       for msg_id in added[start:start + maxResults]]
+            response = {'history': records, 'historyId': str(self.history_id)}
+            if start + maxResults < len(added):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return _Request(self, 'history.list', handler)
+
+    def _labels_list(self, userId):
+        return _Request(self, 'labels.list', lambda: {'labels': list(self.labels)})
+
+    def _labels_create(self, userId, body):
+        def handler():
+            label = {'id': f'Label_{len(self.labels)}', 'name': body['name']}
+            self.labels.append(label)
+            return label
+        return _Request(self, 'labels.create', handler)
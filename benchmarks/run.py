@@ -0,0 +1,206 @@
+"""
+Throughput benchmarks for fetch.fetch_emails and rules.apply_rules against FakeGmail.
+
+    python benchmarks/run.py --messages 2000 --latency 0.005 --error-rate 0.01 --page-size 500 --output results.json
+
+Every scenario runs in a fresh temporary directory. The results are printed as JSON,
+and also written to --output if given, so runs of two versions can be diffed. Per
+scenario, the results report wall time, messages (or rule evaluations) per second,
+quota-level API calls and HTTP round trips per processed message, injected 429s and
+client retries.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fetch
+import rules
+from fake_gmail import WORDS, FakeGmail
+from gmail_client import GmailClient
+
+FETCH_SCENARIOS = {
+    'fetch_sequential': {'batch_size': None, 'concurrency': 1},
+    'fetch_batched': {'batch_size': 100, 'concurrency': 1},
+    'fetch_pipelined': {'batch_size': 50, 'concurrency': 4},
+    'fetch_metadata': {'batch_size': 100, 'concurrency': 1, 'message_format': 'metadata'},
+}
+
+RULE_SCENARIOS = {
+    'rules_serial': {},
+    'rules_sql_pushdown': {'sql_pushdown': True},
+    'rules_workers': {'workers': max(2, min(4, os.cpu_count() or 1))},
+}
+
+def quiet(msg):
+    pass
+
+def make_rules(count, seed=2):
+    """
+    Returns `count` sender/subject rules with a mix of predicates and actions.
+    """
+    rng = random.Random(seed)
+    actions = ["mark_as_read", "add_star", "move_to_label:Archive", "mark_as_unread"]
+    return {"rules": [
+        {"predicate": rng.choice(["All", "Any"]), "conditions": [
+            {"field": "from", "operator": "contains", "value": f"{rng.choice(WORDS)}{rng.randrange(300)}@"},
+            {"field": "subject", "operator": rng.choice(["contains", "does_not_contain"]), "value": rng.choice(WORDS)},
+        ], "actions": [rng.choice(actions)]}
+        for _ in range(count)
+    ]}
+
+def api_stats(fake, client, processed):
+    calls = sum(fake.calls.values())
+    return {
+        'api_calls': calls,
+        'http_requests': fake.http_requests,
+        'api_calls_per_message': round(calls / processed, 3) if processed else None,
+        'http_requests_per_message': round(fake.http_requests / processed, 3) if processed else None,
+        'calls_by_method': dict(fake.calls),
+        'injected_429s': fake.errors,
+        'retries': client.stats['retries'],
+    }
+
+def count_rows(db_path, where='1'):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(f'SELECT COUNT(*) FROM emails WHERE {where}').fetchone()[0]
+    finally:
+        conn.close()
+
+def run_fetch(name, options, args, workdir):
+    fake = FakeGmail(args.messages, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    client = GmailClient(units_per_second=args.quota)
+    db_path = os.path.join(workdir, f'{name}.db')
+    with patch.object(fetch, 'authenticate', return_value=None), patch.object(fetch, 'build', return_value=fake):
+        started = time.perf_counter()
+        fetch.fetch_emails(db_path=db_path, number_or_date=str(args.messages), page_size=args.page_size,
+                           log_callback=quiet, client=client, **options)
+        elapsed = time.perf_counter() - started
+    stored = count_rows(db_path)
+    return db_path, {
+        'name': name, 'options': options, 'seconds': round(elapsed, 4), 'messages': stored,
+        'messages_per_sec': round(stored / elapsed, 1), **api_stats(fake, client, stored),
+    }
+
+def run_incremental(args, workdir):
+    """
+    Full incremental sync (untimed), then `--new` new messages, then a timed incremental sync.
+    """
+    fake = FakeGmail(args.messages, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    client = GmailClient(units_per_second=args.quota)
+    db_path = os.path.join(workdir, 'incremental.db')
+    with patch.object(fetch, 'authenticate', return_value=None), patch.object(fetch, 'build', return_value=fake):
+        fetch.fetch_emails(db_path=db_path, retrieval_method="incremental", batch_size=100, page_size=args.page_size,
+                           log_callback=quiet, client=client)
+        before = count_rows(db_path)
+        fake.deliver(args.new)
+        fake.reset_counters()
+        client = GmailClient(units_per_second=args.quota)
+        started = time.perf_counter()
+        fetch.fetch_emails(db_path=db_path, retrieval_method="incremental", batch_size=100,
+                           page_size=args.page_size, log_callback=quiet, client=client)
+        elapsed = time.perf_counter() - started
+    added = count_rows(db_path) - before
+    return {
+        'name': 'fetch_incremental', 'options': {'new_messages': args.new}, 'seconds': round(elapsed, 4),
+        'messages': added, 'messages_per_sec': round(added / elapsed, 1) if elapsed else None,
+        **api_stats(fake, client, added),
+    }
+
+def run_rules(name, options, args, source_db, workdir):
+    """
+    Applies `--rules` synthetic rules to a copy of a fetched database.
+    """
+    scenario_dir = os.path.join(workdir, name)
+    os.makedirs(scenario_dir)
+    db_path = os.path.join(scenario_dir, 'emails.db')
+    shutil.copy(source_db, db_path)
+    rules_data = make_rules(args.rules, args.seed)
+    with open(os.path.join(scenario_dir, 'rules.json'), 'w') as file:
+        json.dump(rules_data, file)
+    unread = count_rows(db_path, 'is_read = 0')
+    fake = FakeGmail(0, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    fake.labels.append({'id': 'Label_Archive', 'name': 'Archive'})
+    # batchModify needs the messages to exist in the fake mailbox.
+    conn = sqlite3.connect(db_path)
+    for (msg_id,) in conn.execute('SELECT id FROM emails'):
+        fake.messages[msg_id] = {'labelIds': ['INBOX', 'UNREAD']}
+    conn.close()
+    client = GmailClient(units_per_second=args.quota)
+    cwd = os.getcwd()
+    os.chdir(scenario_dir)
+    try:
+        with patch.object(rules, 'authenticate', return_value=None), patch.object(rules, 'build', return_value=fake):
+            started = time.perf_counter()
+            rules.apply_rules(db_path=db_path, log_callback=quiet, client=client, **options)
+            elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+    evaluations = unread * args.rules
+    return {
+        'name': name, 'options': options, 'seconds': round(elapsed, 4), 'messages': unread,
+        'rule_evaluations': evaluations, 'rule_evaluations_per_sec': round(evaluations / elapsed, 1),
+        'messages_per_sec': round(unread / elapsed, 1), **api_stats(fake, client, unread),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000, help='synthetic mailbox size')
+    parser.add_argument('--new', type=int, default=200, help='messages delivered before the incremental sync')
+    parser.add_argument('--rules', type=int, default=100, help='synthetic rules for apply_rules')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per HTTP round trip')
+    parser.add_argument('--page-size', type=int, default=500, help='ids per messages.list page (Gmail allows 500)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 429 per API call')
+    parser.add_argument('--quota', type=float, default=1e9,
+                        help='client quota units per second (Gmail allows 250; default: unthrottled)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='scenario names to run')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args(argv)
+
+    selected = lambda name: not args.only or name in args.only
+    results = []
+    workdir = tempfile.mkdtemp(prefix='email-bench-')
+    try:
+        fetched_db = None
+        for name, options in FETCH_SCENARIOS.items():
+            if selected(name) or (name == 'fetch_batched' and any(selected(rule) for rule in RULE_SCENARIOS)):
+                db_path, result = run_fetch(name, options, args, workdir)
+                if selected(name):
+                    results.append(result)
+                if name == 'fetch_batched':
+                    fetched_db = db_path
+        if selected('fetch_incremental'):
+            results.append(run_incremental(args, workdir))
+        for name, options in RULE_SCENARIOS.items():
+            if selected(name):
+                results.append(run_rules(name, options, args, fetched_db, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    return report
+
+if __name__ == '__main__':
+    main()
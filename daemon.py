@@ -0,0 +1,149 @@
+import argparse
+import json
+import random
+import signal
+import threading
+import time
+from collections import deque
+from fetch import fetch_emails
+from gmail_client import GmailClient
+from rules import apply_rules
+from session import authenticate, http_pool
+from storage import EmailStore
+
+DEFAULT_INTERVAL = 300
+DEFAULT_JITTER = 30
+# Cycles kept in Daemon.history.
+HISTORY_SIZE = 100
+# sync_state key holding the rowid after which stored emails still await apply_rules.
+RULES_PENDING_KEY = 'daemon_rules_after_rowid'
+
+class Daemon:
+    """
+    Long-running fetch-then-apply loop. Each cycle runs an incremental fetch_emails and
+    then apply_rules on only the emails that cycle stored, so rules act on new mail once.
+    The EmailStore connection, the GmailClient and its connection pool are opened once
+    and kept for every cycle, and credentials and the Gmail service come from the
+    process-wide session cache, so a cycle costs only its API calls and SQLite work.
+    Cycles start every `interval` seconds, plus or minus up to `jitter` seconds so that
+    several daemons do not hit the API in lockstep. stop() (called on SIGTERM and SIGINT
+    by main) also cancels the running fetch or apply_rules at its next chunk boundary;
+    fetches resume from their checkpoint, and emails stored by a cycle whose rules did not
+    finish are evaluated by the next cycle (see RULES_PENDING_KEY). Per-cycle timings and
+    counts are logged, kept in `history` and, with `stats_file`, appended to it as JSON
+    lines. With `metrics_file`, the client's metrics are exported after every fetch and
+    rules run (see Metrics.export).
+    """
+
+    def __init__(self, credentials_file="credentials.json", db_path="emails.db", interval=DEFAULT_INTERVAL,
+                 jitter=DEFAULT_JITTER, log_callback=print, stats_file=None, fetch_options=None, rules_options=None,
+                 metrics_file=None):
+        self.credentials_file = credentials_file
+        self.db_path = db_path
+        self.interval = interval
+        self.jitter = jitter
+        self.log_callback = log_callback
+        self.stats_file = stats_file
+        self.fetch_options = {'batch_size': 100, 'resume': True, 'metrics_file': metrics_file, **(fetch_options or {})}
+        self.rules_options = {'metrics_file': metrics_file, **(rules_options or {})}
+        self.stopping = threading.Event()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.cycles = 0
+        self.store = None
+        self.client = None
+
+    def stop(self, *args):
+        """
+        Asks the running fetch or apply_rules to stop at its next chunk and the loop to exit
+        after the current cycle. Usable as a signal handler.
+        """
+        if not self.stopping.is_set():
+            self.log_callback("Stopping after the current cycle.")
+        self.stopping.set()
+
+    def next_delay(self):
+        """
+        Returns the seconds to wait before the next cycle.
+        """
+        return max(0.0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+    def run_cycle(self):
+        """
+        Runs one fetch and apply cycle and returns its stats. Errors are logged and
+        recorded in the stats rather than raised, so one bad cycle does not end the daemon.
+        """
+        self.cycles += 1
+        stats = {'cycle': self.cycles, 'started_at': time.time(), 'new_emails': 0,
+                 'fetch_seconds': 0.0, 'rules_seconds': 0.0, 'api_calls': 0, 'error': None}
+        calls_before = self.client.metrics.total('api_calls')
+        started = time.perf_counter()
+        try:
+            before = self.store.max_rowid()
+            pending = self.store.get_state(RULES_PENDING_KEY)
+            after_rowid = before if pending is None else int(pending)
+            fetch_emails(self.credentials_file, self.db_path, retrieval_method="incremental",
+                         log_callback=self.log_callback, client=self.client, store=self.store,
+                         cancel=self.stopping, **self.fetch_options)
+            fetched = time.perf_counter()
+            stats['fetch_seconds'] = round(fetched - started, 4)
+            stats['new_emails'] = self.store.max_rowid() - before
+            if self.store.max_rowid() > after_rowid:
+                # Kept until the rules have run, so a stopped or failed cycle's emails are not skipped.
+                self.store.set_state(RULES_PENDING_KEY, after_rowid)
+                self.store.flush()
+                if not self.stopping.is_set():
+                    apply_rules(self.credentials_file, self.db_path, log_callback=self.log_callback, client=self.client,
+                                store=self.store, after_rowid=after_rowid, cancel=self.stopping, **self.rules_options)
+                    stats['rules_seconds'] = round(time.perf_counter() - fetched, 4)
+                if not self.stopping.is_set():
+                    self.store.delete_state(RULES_PENDING_KEY)
+                    self.store.flush()
+        except Exception as error:
+            stats['error'] = f"{type(error).__name__}: {error}"
+            self.log_callback(f"Cycle {self.cycles} failed: {stats['error']}")
+        stats['seconds'] = round(time.perf_counter() - started, 4)
+        stats['api_calls'] = self.client.metrics.total('api_calls') - calls_before
+        self.history.append(stats)
+        self.log_callback(f"Cycle {stats['cycle']}: {stats['new_emails']} new emails, fetch {stats['fetch_seconds']:.2f}s, "
+                          f"rules {stats['rules_seconds']:.2f}s, {stats['api_calls']} API calls.")
+        if self.stats_file:
+            with open(self.stats_file, 'a') as file:
+                file.write(json.dumps(stats) + '\n')
+        return stats
+
+    def run(self, max_cycles=None):
+        """
+        Runs cycles until stop() is called (or `max_cycles` have run), then closes the store.
+        """
+        self.store = EmailStore(self.db_path)
+        self.client = GmailClient(pool=http_pool(authenticate(self.credentials_file)))
+        try:
+            while not self.stopping.is_set():
+                self.run_cycle()
+                if max_cycles is not None and self.cycles >= max_cycles:
+                    break
+                self.stopping.wait(self.next_delay())
+        finally:
+            self.store.close()
+            self.store = None
+        self.log_callback(f"Daemon stopped after {self.cycles} cycles.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch new emails and apply rules.json to them on an interval.")
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='seconds between cycles')
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER, help='random +/- seconds added to the interval')
+    parser.add_argument('--db', default='emails.db', help='SQLite database path')
+    parser.add_argument('--credentials', default='credentials.json')
+    parser.add_argument('--stats-file', help='append per-cycle stats to this JSON lines file')
+    parser.add_argument('--metrics-file', help='export metrics to this file: Prometheus text, or JSON lines if it ends in .jsonl')
+    parser.add_argument('--cycles', type=int, help='exit after this many cycles')
+    args = parser.parse_args(argv)
+
+    daemon = Daemon(args.credentials, args.db, interval=args.interval, jitter=args.jitter, stats_file=args.stats_file,
+                    metrics_file=args.metrics_file)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run(max_cycles=args.cycles)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 import sqlite3
 import base64
-import json
 from googleapiclient.discovery import build
 from authenticate import authenticate
+from rule_store import get_rule_store
 
 def setup_database():
     conn = sqlite3.connect('emails.db')
@@ -63,8 +63,7 @@ def apply_rules():
     creds = authenticate()
     service = build('gmail', 'v1', credentials=creds)
 
-    with open('rules.json', 'r') as file:
-        rules_data = json.load(file)
+    rules_data = get_rule_store('rules.json').load()
 
     cursor.execute('SELECT id, sender, subject, message FROM emails WHERE is_read = 0')
     emails = cursor.fetchall()
@@ -1,107 +1,595 @@
-import sqlite3
-import base64
-from googleapiclient.discovery import build
-from authenticate import authenticate
+import asyncio
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from gmail_client import GmailClient, is_retryable
+from metrics import LogSampler, format_summary
+from payload import extract_body
+from session import authenticate, build, cold_start_summary, http_pool
+from storage import EmailStore
+from transport import HttpPool
+
+# Gmail rejects batch requests with more than 100 calls.
+MAX_BATCH_SIZE = 100
+# Largest page size accepted by messages().list.
+MAX_PAGE_SIZE = 500
+# Headers requested by the metadata fetch format.
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+# messages().list leaves these out by default, so incremental syncs skip them too.
+EXCLUDED_LABELS = ('SPAM', 'TRASH')
 
 def setup_database(db_path='emails.db'):
     """
     Creates the emails table if it does not exist and returns a (connection, cursor) pair.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS emails (
-            id TEXT PRIMARY KEY,
-            sender TEXT,
-            subject TEXT,
-            received_at TEXT,
-            message TEXT,
-            is_read INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-    return conn, cursor
-
-def fetch_emails(credentials_file="credentials.json", db_path="emails.db", retrieval_method="number", number_or_date="10", log_callback=print):
+    store = EmailStore(db_path)
+    return store.conn, store.cursor
+
+def parse_message(message, include_body=True, max_body_chars=None):
+    """
+    Converts a Gmail message resource into an emails table row:
+    (id, sender, subject, received_at, message, is_read).
+    The body is the text of all text/plain parts (see payload.extract_body), cut at
+    `max_body_chars` characters if given. With `include_body=False` (metadata fetches)
+    the message is None, marking the body as not downloaded yet.
+    """
+    sender = ''
+    subject = ''
+    received_at = message.get('internalDate', '')
+    label_ids = message.get('labelIds', [])
+    is_read = 0
+    if 'UNREAD' not in label_ids:
+        is_read = 1
+
+    headers = message['payload'].get('headers', [])
+    for header in headers:
+        if header['name'] == 'From':
+            sender = header['value']
+        elif header['name'] == 'Subject':
+            subject = header['value']
+
+    message_body = extract_body(message.get('payload', {}), max_body_chars) if include_body else None
+
+    return (message['id'], sender, subject, received_at, message_body, is_read)
+
+def _get_request(service, msg_id, message_format='full'):
+    """
+    Builds the messages().get request for `msg_id` in the given format ("full" or "metadata").
+    """
+    if message_format == 'metadata':
+        return service.users().messages().get(userId='me', id=msg_id, format='metadata',
+                                              metadataHeaders=METADATA_HEADERS)
+    return service.users().messages().get(userId='me', id=msg_id)
+
+def fetch_message_batch(service, msg_ids, max_retries=5, log_callback=print, http=None, client=None,
+                        message_format='full', failed=None):
+    """
+    Fetches the given message ids with Gmail batch requests and returns the message
+    resources in the order of `msg_ids`. `http` overrides the service's transport.
+    Each batch request goes through `client`, which charges the quota of all its calls
+    and retries the request itself on 5xx and connection errors. Items that failed with
+    a rate limit or 5xx are retried in a follow-up batch after the client's backoff, up
+    to `max_retries` times; ids still failing then are appended to `failed`. Other
+    per-item errors (e.g. a deleted message) are logged and skipped.
+    """
+    client = client or GmailClient()
+    results = {}
+    pending = list(dict.fromkeys(msg_ids))
+    attempt = 0
+    while pending:
+        retry = []
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif is_retryable(exception):
+                retry.append(request_id)
+                errors[request_id] = exception
+            else:
+                log_callback(f"Failed to fetch email {request_id}: {exception}")
+
+        batch = service.new_batch_http_request(callback=callback)
+        for msg_id in pending:
+            batch.add(_get_request(service, msg_id, message_format), request_id=msg_id)
+        client.execute(batch, 'messages.get', http=http, calls=len(pending))
+
+        retry = list(dict.fromkeys(retry))
+        if not retry:
+            break
+        attempt += 1
+        if attempt > max_retries:
+            log_callback(f"Giving up on {len(retry)} emails after {max_retries} retries.")
+            if failed is not None:
+                failed.extend(retry)
+            break
+        client.backoff(attempt, errors[retry[0]])
+        pending = retry
+
+    return [results[msg_id] for msg_id in msg_ids if msg_id in results]
+
+def _get_message(service, msg_id, log_callback=print, http=None, client=None, message_format='full'):
+    """
+    Fetches a single message resource through `client`, returning None if it no longer
+    exists. `http` overrides the service's transport.
+    """
+    client = client or GmailClient()
+    try:
+        return client.execute(_get_request(service, msg_id, message_format), 'messages.get', http=http)
+    except HttpError as error:
+        if error.resp.status != 404:
+            raise
+        log_callback(f"Email {msg_id} no longer exists, skipping.")
+        return None
+
+def hydrate_bodies(service, store, email_ids=None, unread_only=True, batch_size=MAX_BATCH_SIZE, client=None,
+                   log_callback=print, max_body_chars=None, cancel=None, after_rowid=None):
+    """
+    Downloads the bodies of stored emails fetched in metadata format (message IS NULL),
+    optionally restricted to `email_ids`, to unread emails and to rowids above `after_rowid`,
+    and writes them to `store`. Bodies are fetched with batch requests of `batch_size`
+    calls, or one request per email if `batch_size` is None. Stops before the next chunk
+    once `cancel` is set. Returns the number of emails hydrated.
+    """
+    client = client or GmailClient()
+    pending = store.unhydrated_ids(email_ids, unread_only, after_rowid)
+    hydrated = 0
+    chunk_size = min(batch_size, MAX_BATCH_SIZE) if batch_size else MAX_BATCH_SIZE
+    for chunk in _chunked(pending, chunk_size):
+        if _cancelled(cancel):
+            break
+        if batch_size:
+            fetched = fetch_message_batch(service, chunk, log_callback=log_callback, client=client)
+        else:
+            fetched = (_get_message(service, msg_id, log_callback, client=client) for msg_id in chunk)
+        fetched = [message for message in fetched if message is not None]
+        with client.metrics.timer('decode_seconds'):
+            bodies = [(extract_body(message.get('payload', {}), max_body_chars), message['id']) for message in fetched]
+        with client.metrics.timer('insert_seconds'):
+            store.update_bodies(bodies)
+            store.flush()
+        hydrated += len(bodies)
+    if hydrated:
+        log_callback(f"Downloaded {hydrated} email bodies.")
+    return hydrated
+
+def list_history_changes(service, start_history_id, client=None):
+    """
+    Walks users().history().list from `start_history_id` and returns a tuple of
+    (added message ids, {message id: is_read} for UNREAD label changes, latest history id).
+    Messages added to spam or trash are left out, as they are by a full sync. Raises HttpError with status 404 if `start_history_id` has expired.
+    """
+    client = client or GmailClient()
+    added_ids = []
+    read_state = {}
+    params = {
+        'userId': 'me',
+        'startHistoryId': start_history_id,
+        'historyTypes': ['messageAdded', 'labelAdded', 'labelRemoved'],
+        'maxResults': MAX_PAGE_SIZE,
+    }
+    latest_history_id = start_history_id
+    while True:
+        response = client.execute(service.users().history().list(**params), 'history.list')
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                if not any(label in EXCLUDED_LABELS for label in added['message'].get('labelIds', [])):
+                    added_ids.append(added['message']['id'])
+            for change in record.get('labelsAdded', []):
+                if 'UNREAD' in change.get('labelIds', []):
+                    read_state[change['message']['id']] = 0
+            for change in record.get('labelsRemoved', []):
+                if 'UNREAD' in change.get('labelIds', []):
+                    read_state[change['message']['id']] = 1
+        latest_history_id = response.get('historyId', latest_history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+        params['pageToken'] = page_token
+    return list(dict.fromkeys(added_ids)), read_state, latest_history_id
+
+def iter_message_pages(service, query_params, page_size=100, limit=None, client=None, page_token=None):
+    """
+    Lazily walks the pages of messages().list for `query_params`, starting from `page_token`
+    if given, and yields (message ids, next page token) pairs. The token is None for the
+    last page, including the page on which `limit` ids have been reached.
+    """
+    client = client or GmailClient()
+    params = dict(query_params)
+    if page_token:
+        params['pageToken'] = page_token
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    yielded = 0
+    while True:
+        params['maxResults'] = page_size if limit is None else min(page_size, limit - yielded)
+        response = client.execute(service.users().messages().list(**params), 'messages.list')
+        msg_ids = [msg['id'] for msg in response.get('messages', [])]
+        if limit is not None:
+            msg_ids = msg_ids[:limit - yielded]
+        yielded += len(msg_ids)
+        page_token = response.get('nextPageToken')
+        if limit is not None and yielded >= limit:
+            page_token = None
+        yield msg_ids, page_token
+        if not page_token:
+            return
+        params['pageToken'] = page_token
+
+def iter_message_ids(service, query_params, page_size=100, limit=None, client=None):
+    """
+    Lazily walks every page of messages().list for `query_params` and yields message ids.
+    Only one page is held in memory at a time. Stops after `limit` ids if a limit is given.
+    """
+    for msg_ids, _ in iter_message_pages(service, query_params, page_size, limit, client):
+        yield from msg_ids
+
+def _chunked(iterable, size):
+    """
+    Groups an iterable into lists of at most `size` items without materializing it.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class SyncCheckpoint:
+    """
+    Listing progress of a fetch run, kept in the sync_state table so that an interrupted
+    run can resume. After every fully stored page it records the token of the next page
+    and the number of ids listed so far. The checkpoint is written on the store's
+    connection, and every commit first flushes the buffered rows, so it never gets ahead
+    of the stored emails.
+    """
+
+    KEY = 'fetch_checkpoint'
+
+    def __init__(self, store, query, history_id=None):
+        self.store = store
+        self.query = query
+        self.history_id = history_id
+        self.listed = 0
+        self.held = False
+
+    def load(self):
+        """
+        Returns the saved checkpoint for this query as a dict, or None if there is none.
+        """
+        saved = self.store.get_state(self.KEY)
+        if saved is None:
+            return None
+        checkpoint = json.loads(saved)
+        return checkpoint if checkpoint['query'] == self.query else None
+
+    def page_done(self, listed, next_page_token):
+        """
+        Records that a page of `listed` ids is stored and listing continues at `next_page_token`.
+        """
+        self.listed += listed
+        if next_page_token and not self.held:
+            self.store.set_state(self.KEY, json.dumps({
+                'query': self.query,
+                'page_token': next_page_token,
+                'listed': self.listed,
+                'history_id': self.history_id,
+            }))
+
+    def hold(self):
+        """
+        Stops recording progress because emails of a page could not be fetched, so the
+        saved checkpoint stays at the last page that was fully stored.
+        """
+        self.held = True
+
+    def finish(self):
+        """
+        Removes the checkpoint once the run has completed.
+        """
+        self.store.delete_state(self.KEY)
+
+def _cancelled(cancel):
+    """
+    Returns True if `cancel` (a threading.Event or None) has been set.
+    """
+    return cancel is not None and cancel.is_set()
+
+def _log_stored(rows, sampler, log_callback):
+    """
+    Logs the stored emails of `rows` that `sampler` (a LogSampler) selects.
+    """
+    for row in rows:
+        if sampler.sample():
+            log_callback(f"Storing Email - ID: {row[0]}, Sender: {row[1]}, Subject: {row[2]}, Date: {row[3]}")
+
+def _store_rows(store, rows, metrics):
+    """
+    Buffers parsed rows in `store`, timing the insert and counting the emails in `metrics`.
+    """
+    with metrics.timer('insert_seconds'):
+        store.insert_emails(rows)
+    metrics.count('emails_processed', len(rows), {'stage': 'fetch'})
+
+def _ingest_sequential(service, store, pages, chunk_size, batch_size, client, checkpoint, message_format,
+                       max_body_chars, sampler, cancel, log_callback):
+    """
+    Fetches, parses and stores the ids of each (ids, next page token) page in `pages`,
+    one chunk at a time on the calling thread, recording each finished page in `checkpoint`.
+    Stops before the next chunk once `cancel` is set.
+    Returns (stored count, skipped count, ids that could not be fetched).
+    """
+    total = 0
+    skipped = 0
+    failed = []
+    for msg_ids, next_page_token in pages:
+        for chunk in _chunked(msg_ids, chunk_size):
+            if _cancelled(cancel):
+                return total, skipped, failed
+            unknown = store.filter_unknown_ids(chunk)
+            skipped += len(chunk) - len(unknown)
+            chunk = unknown
+            if not chunk:
+                continue
+            if batch_size:
+                fetched = fetch_message_batch(service, chunk, log_callback=log_callback, client=client,
+                                              message_format=message_format, failed=failed)
+            else:
+                fetched = (_get_message(service, msg_id, log_callback, client=client, message_format=message_format)
+                           for msg_id in chunk)
+
+            fetched = [message for message in fetched if message is not None]
+            with client.metrics.timer('decode_seconds'):
+                rows = [parse_message(message, message_format != 'metadata', max_body_chars) for message in fetched]
+            _log_stored(rows, sampler, log_callback)
+            _store_rows(store, rows, client.metrics)
+            total += len(rows)
+        if checkpoint:
+            if failed:
+                checkpoint.hold()
+            checkpoint.page_done(len(msg_ids), next_page_token)
+    return total, skipped, failed
+
+async def _ingest_pipelined(service, store, pages, batch_size, concurrency, connections, client, checkpoint,
+                            message_format, max_body_chars, sampler, cancel, log_callback):
+    """
+    Runs the fetch as a pipeline of asyncio stages connected by bounded queues:
+    a producer that lists pages and drops already-stored ids, `concurrency` detail
+    fetchers running on a thread pool (each call borrowing a connection from the HttpPool
+    `connections`, since httplib2 is not thread-safe) sharing one rate-limited `client`,
+    a parser, and a single writer that owns the SQLite connection. Full queues block the
+    stage upstream of them, so a slow API or disk never causes unbounded buffering.
+    Pages are recorded in `checkpoint` in listing order once all of their work is stored,
+    until an email fails to be fetched. Once `cancel` is set, no more pages are listed
+    and queued work is dropped, so the pipeline drains quickly.
+    Returns (stored count, skipped count, ids that could not be fetched).
+    """
+    loop = asyncio.get_running_loop()
+    work_queue = asyncio.Queue(maxsize=concurrency * 2)
+    message_queue = asyncio.Queue(maxsize=concurrency * 2)
+    row_queue = asyncio.Queue(maxsize=concurrency * 2)
+    counts = {'stored': 0, 'skipped': 0}
+    failed = []
+    # Pages in listing order as [outstanding work items, ids listed, next page token].
+    open_pages = deque()
+    done = object()
+
+    def fetch_work(work):
+        with connections.acquire() as http:
+            if batch_size:
+                return fetch_message_batch(service, work, log_callback=log_callback, http=http, client=client,
+                                           message_format=message_format, failed=failed)
+            message = _get_message(service, work[0], log_callback, http=http, client=client,
+                                   message_format=message_format)
+        return [message] if message is not None else []
+
+    def complete_pages():
+        while open_pages and open_pages[0][0] == 0:
+            _, listed, next_page_token = open_pages.popleft()
+            if checkpoint:
+                if failed:
+                    checkpoint.hold()
+                checkpoint.page_done(listed, next_page_token)
+
+    async def produce():
+        page_iter = iter(pages)
+        while not _cancelled(cancel):
+            # Listing pages is blocking I/O, so it runs on the default executor.
+            page = await loop.run_in_executor(None, next, page_iter, None)
+            if page is None:
+                break
+            msg_ids, next_page_token = page
+            unknown = store.filter_unknown_ids(msg_ids)
+            counts['skipped'] += len(msg_ids) - len(unknown)
+            work_size = min(batch_size, MAX_BATCH_SIZE) if batch_size else 1
+            work_items = [unknown[start:start + work_size] for start in range(0, len(unknown), work_size)]
+            page = [len(work_items), len(msg_ids), next_page_token]
+            open_pages.append(page)
+            complete_pages()
+            for work in work_items:
+                await work_queue.put((page, work))
+        for _ in range(concurrency):
+            await work_queue.put(done)
+
+    async def fetch_details(pool):
+        while True:
+            item = await work_queue.get()
+            if item is done:
+                await message_queue.put(done)
+                return
+            page, work = item
+            if _cancelled(cancel):
+                continue
+            await message_queue.put((page, await loop.run_in_executor(pool, fetch_work, work)))
+
+    async def parse():
+        finished = 0
+        while finished < concurrency:
+            item = await message_queue.get()
+            if item is done:
+                finished += 1
+                continue
+            page, messages = item
+            include_body = message_format != 'metadata'
+            with client.metrics.timer('decode_seconds'):
+                rows = [parse_message(message, include_body, max_body_chars) for message in messages]
+            await row_queue.put((page, rows))
+        await row_queue.put(done)
+
+    async def write():
+        while True:
+            item = await row_queue.get()
+            if item is done:
+                return
+            page, rows = item
+            _log_stored(rows, sampler, log_callback)
+            _store_rows(store, rows, client.metrics)
+            counts['stored'] += len(rows)
+            page[0] -= 1
+            complete_pages()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        tasks = [asyncio.ensure_future(produce())]
+        tasks += [asyncio.ensure_future(fetch_details(pool)) for _ in range(concurrency)]
+        tasks += [asyncio.ensure_future(parse()), asyncio.ensure_future(write())]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # The first failure stops the other stages, which would otherwise wait on their queues forever.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    return counts['stored'], counts['skipped'], failed
+
+def fetch_emails(credentials_file="credentials.json", db_path="emails.db", retrieval_method="number",
+                 number_or_date="10", log_callback=print, batch_size=None, page_size=100, limit=None, concurrency=1,
+                 client=None, resume=False, message_format="full", max_body_chars=None, store=None, log_every=0,
+                 metrics_file=None, cancel=None):
     """
     Fetches emails from Gmail using the specified retrieval method:
       - "number": fetch up to `number_or_date` emails.
       - "timestamp": fetch emails after the given date (YYYY-MM-DD).
+      - "incremental": fetch only changes since the last incremental run (see
+        list_history_changes), or the whole mailbox when there is no usable history id.
     Stores them in the SQLite database located at `db_path` and logs progress via `log_callback`.
+    Ids are listed `page_size` at a time and fetched with fetch_message_batch (batch_size),
+    _ingest_pipelined (concurrency) or one by one; SyncCheckpoint handles `resume`, and
+    setting `cancel` (a threading.Event) stops the run at the next chunk. A `store` passed
+    in is flushed but left open.
     """
-    # Setup the database.
-    conn, cursor = setup_database(db_path)
+    # Open the email store, unless the caller keeps one open.
+    owns_store = store is None
+    store = store or EmailStore(db_path)
+    close_store = store.close if owns_store else store.flush
 
-    # Authenticate and build the Gmail API service.
-    creds = authenticate(credentials_file)
-    service = build('gmail', 'v1', credentials=creds)
+    try:
+        # Authenticate and build the Gmail API service.
+        creds = authenticate(credentials_file)
+        service = build('gmail', 'v1', credentials=creds)
+        summary = cold_start_summary()
+        if summary:
+            log_callback(summary)
+        client = client or GmailClient(pool=http_pool(creds))
+        started = client.metrics.snapshot()
+        sampler = LogSampler(log_every)
 
-    # Build query parameters.
-    query_params = {'userId': 'me'}
-    if retrieval_method == "number":
-        try:
-            max_results = int(number_or_date)
-        except ValueError:
-            max_results = 10
-        query_params['maxResults'] = max_results
-    elif retrieval_method == "timestamp":
-        query_params['q'] = f'after:{number_or_date}'
-    else:
-        log_callback(f"Invalid retrieval method: {retrieval_method}")
-        return
-
-    # Fetch messages.
-    results = service.users().messages().list(**query_params).execute()
-    messages = results.get('messages', [])
-
-    if not messages:
-        log_callback("No emails found.")
-        return
-
-    log_callback(f"{len(messages)} emails fetched and stored successfully!")
-
-    # Process each message.
-    for msg in messages:
-        msg_id = msg['id']
-        message = service.users().messages().get(userId='me', id=msg_id).execute()
-
-        sender = ''
-        subject = ''
-        received_at = message.get('internalDate', '')
-        message_body = ''
-        label_ids = message.get('labelIds', [])
-        is_read = 0
-        if 'UNREAD' not in label_ids:
-            is_read = 1
-
-        headers = message['payload'].get('headers', [])
-        for header in headers:
-            if header['name'] == 'From':
-                sender = header['value']
-            elif header['name'] == 'Subject':
-                subject = header['value']
-
-        payload = message.get('payload', {})
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part.get('mimeType') == 'text/plain':
-                    data = part['body'].get('data', '')
-                    if data:
-                        decoded = base64.urlsafe_b64decode(data).decode('utf-8', errors='ignore')
-                        message_body += decoded
+        # Build query parameters.
+        query_params = {'userId': 'me'}
+        if retrieval_method == "number":
+            try:
+                max_results = int(number_or_date)
+            except ValueError:
+                max_results = 10
+            limit = max_results if limit is None else min(limit, max_results)
+        elif retrieval_method == "timestamp":
+            query_params['q'] = f'after:{number_or_date}'
+        elif retrieval_method != "incremental":
+            log_callback(f"Invalid retrieval method: {retrieval_method}")
+            return
+
+        latest_history_id = None
+        checkpoint = None
+        full_listing = True
+        if retrieval_method == "incremental":
+            history_id = store.get_state('history_id')
+            if history_id:
+                try:
+                    msg_ids, read_state, latest_history_id = list_history_changes(service, history_id, client)
+                except HttpError as error:
+                    if error.resp.status != 404:
+                        raise
+                    log_callback("Stored history id has expired; falling back to a full sync.")
+                    history_id = None
+            if history_id:
+                # Apply read-state changes before inserting, so only previously stored rows are touched.
+                store.update_read_state(read_state)
+                log_callback(f"Updated read state for {len(read_state)} emails.")
+                pages = [(msg_ids, None)]
+                full_listing = False
+
+        if full_listing:
+            checkpoint = SyncCheckpoint(store, {'method': retrieval_method, 'params': query_params, 'limit': limit})
+            saved = checkpoint.load() if resume else None
+            if saved:
+                log_callback(f"Resuming from checkpoint after {saved['listed']} listed emails.")
+                checkpoint.listed = saved['listed']
+                latest_history_id = saved['history_id']
+            elif retrieval_method == "incremental":
+                # Record the history id before listing so changes made during the sync are not missed.
+                latest_history_id = client.execute(service.users().getProfile(userId='me'), 'getProfile')['historyId']
+            checkpoint.history_id = latest_history_id
+            remaining = limit if limit is None or not saved else limit - saved['listed']
+            pages = iter_message_pages(service, query_params, page_size=page_size, limit=remaining, client=client,
+                                       page_token=saved['page_token'] if saved else None)
+
+        # Stream message ids and process them one chunk at a time.
+        chunk_size = min(batch_size, MAX_BATCH_SIZE) if batch_size else page_size
+        if concurrency > 1:
+            connections = client.pool or HttpPool(creds, size=concurrency)
+            connections.ensure_size(concurrency)
+            total, skipped, failed = asyncio.run(_ingest_pipelined(
+                service, store, pages, batch_size, concurrency, connections, client, checkpoint, message_format,
+                max_body_chars, sampler, cancel, log_callback))
         else:
-            body_data = payload.get('body', {}).get('data', '')
-            if body_data:
-                decoded = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
-                message_body = decoded
+            total, skipped, failed = _ingest_sequential(
+                service, store, pages, chunk_size, batch_size, client, checkpoint, message_format, max_body_chars,
+                sampler, cancel, log_callback)
+        cancelled = _cancelled(cancel)
+
+        # Keep the history id and checkpoint where they were if emails are missing, so the
+        # next run (or a resumed one) fetches them.
+        if not failed and not cancelled:
+            if checkpoint:
+                checkpoint.finish()
+            if latest_history_id is not None:
+                store.set_state('history_id', latest_history_id)
+        store.flush()
+
+        if client.stats['retries']:
+            log_callback(client.summary())
+        if failed:
+            log_callback(f"{len(failed)} emails could not be fetched; they will be retried on the next run.")
+        if cancelled:
+            log_callback(f"Fetch cancelled after storing {total} emails; fetch again (with resume) to continue.")
+            return
+
+        if skipped:
+            log_callback(f"Skipped fetching {skipped} already-stored emails.")
 
-        log_callback(f"Storing Email - ID: {msg_id}, Sender: {sender}, Subject: {subject}, Date: {received_at}")
+        summary = client.metrics.summary(started)
+        log_callback(format_summary("Fetch", summary))
+        if metrics_file:
+            client.metrics.export(metrics_file, "fetch", summary)
 
-        cursor.execute(
-            'INSERT OR IGNORE INTO emails (id, sender, subject, received_at, message, is_read) VALUES (?, ?, ?, ?, ?, ?)',
-            (msg_id, sender, subject, received_at, message_body, is_read)
-        )
+        if total == 0:
+            log_callback("No emails found.")
+            return
 
-    conn.commit()
-    conn.close()
-    log_callback("Emails stored successfully in the database!")
+        log_callback(f"{total} emails fetched and stored successfully!")
+        log_callback("Emails stored successfully in the database!")
+    finally:
+        # Commits what was stored (and the checkpoint) even if the run fails or is cancelled.
+        close_store()
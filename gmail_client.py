@@ -0,0 +1,243 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from googleapiclient.errors import HttpError
+from metrics import Metrics
+
+# Gmail API quota units charged per method (per user).
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'history.list': 2,
+    'labels.list': 1,
+    'labels.create': 5,
+    'getProfile': 1,
+}
+
+# Gmail's per-user limit is 250 quota units per second.
+DEFAULT_UNITS_PER_SECOND = 250
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling Gmail while the circuit breaker is open.
+    """
+
+def is_rate_limited(error):
+    """
+    Returns True if an HttpError is a 429, or a 403 caused by a rate limit.
+    """
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+
+def is_retryable(error):
+    """
+    Returns True if an HttpError is a rate limit or a transient server error.
+    """
+    return is_rate_limited(error) or (isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES)
+
+def retry_after(error):
+    """
+    Returns the Retry-After delay of an HttpError in seconds, or None if it has none.
+    """
+    value = error.resp.get('retry-after') if isinstance(error, HttpError) else None
+    if not isinstance(value, (str, bytes)):
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+class TokenBucket:
+    """
+    Thread-safe token bucket metered in quota units. The refill rate adapts: it is halved
+    when Gmail rate-limits us and creeps back up towards `max_rate` on every success.
+    """
+
+    def __init__(self, rate=DEFAULT_UNITS_PER_SECOND, capacity=None, min_rate=10):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        """
+        Takes `units` tokens, letting the bucket go into debt, and sleeps until the debt is
+        refilled, so requests larger than the capacity are still charged in full.
+        Returns the seconds waited.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            delay = max(0.0, -self.tokens / self.rate)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self, step=1.0):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + step)
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls and rejects calls for
+    `reset_timeout` seconds. After that one trial call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Gmail API circuit breaker is open after repeated failures.")
+            # Half-open: let this call through as the trial and block others until it resolves.
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        Counts a failed call and returns True if this failure opened the circuit.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                newly_opened = self.opened_at is None
+                self.opened_at = time.monotonic()
+                return newly_opened
+            return False
+
+class GmailClient:
+    """
+    Wrapper around googleapiclient request execution shared by fetch and rules.
+    Every call is metered by an adaptive TokenBucket in Gmail quota units, retried with
+    exponential backoff and full jitter (honouring Retry-After) on 429 and 5xx responses,
+    and guarded by a CircuitBreaker. `stats` counts calls, retries, failures, circuit
+    openings and the seconds spent throttled. Safe to share between threads.
+    With a `pool` (a transport.HttpPool), requests run on pooled keep-alive connections
+    unless the caller passes its own http. Calls, HTTP requests and API latency per
+    method are recorded in `metrics` (a metrics.Metrics), which fetch and rules also use
+    for their own stage timings.
+    """
+
+    def __init__(self, units_per_second=DEFAULT_UNITS_PER_SECOND, max_retries=5, base_delay=0.5, max_delay=32,
+                 failure_threshold=5, reset_timeout=30, pool=None, metrics=None):
+        self.bucket = TokenBucket(units_per_second)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.pool = pool
+        self.metrics = metrics or Metrics()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0, 'circuit_opens': 0, 'throttled_seconds': 0.0}
+        self.lock = threading.Lock()
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def throttle(self, units):
+        """
+        Waits for `units` quota units from the rate limiter.
+        """
+        self._count('throttled_seconds', self.bucket.acquire(units))
+
+    def backoff(self, attempt, error=None):
+        """
+        Sleeps before retry number `attempt` (starting at 1), honouring Retry-After if the
+        error carries one, and slows the rate limiter down if the error was a rate limit.
+        """
+        if is_rate_limited(error):
+            self.bucket.slow_down()
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        self._count('retries')
+        self._count('throttled_seconds', delay)
+        time.sleep(delay)
+
+    @contextmanager
+    def connection(self, http=None):
+        """
+        Yields the http to execute a request with: `http` if given, else a connection
+        borrowed from the pool, else None (the service's default http).
+        """
+        if http is not None or self.pool is None:
+            yield http
+        else:
+            with self.pool.acquire() as pooled:
+                yield pooled
+
+    def execute(self, request, method, http=None, calls=1):
+        """
+        Executes a googleapiclient request for Gmail API `method` (a QUOTA_UNITS key) and
+        returns its response. A batch request is executed the same way, charged for its
+        `calls` calls of `method`. Rate limits, 5xx responses and connection errors are retried;
+        other errors, and retryable ones once max_retries is exhausted, are raised. Only
+        exhausted retries count towards the circuit breaker, since a 4xx means Gmail answered.
+        """
+        # Imported here rather than at module level: httplib2 is slow to import.
+        import httplib2
+        units = QUOTA_UNITS.get(method, 5) * calls
+        labels = {'method': method if calls == 1 else 'batch'}
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            self.throttle(units)
+            self._count('calls')
+            self.metrics.count('api_calls', calls, {'method': method})
+            self.metrics.count('http_requests')
+            try:
+                with self.connection(http) as connection, self.metrics.timer('api_latency_seconds', labels):
+                    response = request.execute(http=connection)
+            except (HttpError, httplib2.HttpLib2Error, OSError) as error:
+                self.metrics.count('api_errors', labels=labels)
+                if isinstance(error, HttpError) and not is_retryable(error):
+                    self.breaker.record_success()
+                    raise
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._count('failures')
+                    if self.breaker.record_failure():
+                        self._count('circuit_opens')
+                    raise
+                self.backoff(attempt, error)
+                continue
+            self.breaker.record_success()
+            self.bucket.speed_up()
+            return response
+
+    def summary(self):
+        """
+        Returns a one-line description of the counters for logging.
+        """
+        return (f"Gmail API: {self.stats['calls']} calls, {self.stats['retries']} retries, "
+                f"{self.stats['throttled_seconds']:.1f}s throttled.")
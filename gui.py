@@ -1,8 +1,81 @@
+import time
+# Taken before the other imports so the reported startup time includes them.
+STARTED = time.perf_counter()
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import customtkinter as ctk
 import tkinter.filedialog as fd
 from fetch import fetch_emails
 from rules import apply_rules, add_rule
 
+# Lines kept in the log box; older lines are dropped first.
+MAX_LOG_LINES = 2000
+# How often (ms) the UI drains queued events, and the most it takes per drain.
+DRAIN_INTERVAL_MS = 100
+MAX_EVENTS_PER_DRAIN = 5000
+
+class JobRunner:
+    """
+    Runs fetch/rules jobs one at a time on a worker thread. Jobs report through a
+    log callback that puts ("log", message) events on a thread-safe queue, and a
+    ("done", job name, error) event is queued when a job ends. Cancellation is
+    cooperative: jobs get `cancel`, an Event set by cancel(), and stop at their next
+    chunk or page boundary with their progress committed (fetches can be resumed).
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail-job")
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.running = None
+
+    def log(self, msg):
+        self.events.put(("log", msg))
+
+    def submit(self, name, job, **kwargs):
+        """
+        Starts `job(log_callback=..., cancel=..., **kwargs)` in the background. Returns
+        False if a job is already running.
+        """
+        if self.running:
+            return False
+        self.running = name
+        self.cancel_event.clear()
+        self.executor.submit(self._run, name, job, kwargs)
+        return True
+
+    def _run(self, name, job, kwargs):
+        error = None
+        try:
+            job(log_callback=self.log, cancel=self.cancel_event, **kwargs)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+        if error is None and self.cancel_event.is_set():
+            error = "cancelled"
+        self.running = None
+        self.events.put(("done", name, error))
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def drain(self, max_events=MAX_EVENTS_PER_DRAIN):
+        """
+        Returns up to `max_events` queued events without blocking.
+        """
+        drained = []
+        try:
+            while len(drained) < max_events:
+                drained.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return drained
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
 class MailManagerApp(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -10,7 +83,13 @@ class MailManagerApp(ctk.CTk):
         self.geometry("750x550")
         ctk.set_appearance_mode("dark")  # Options: "dark", "light", "system"
         ctk.set_default_color_theme("blue")
+        self.jobs = JobRunner()
+        self.log_lines = 0
         self.build_ui()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.after(DRAIN_INTERVAL_MS, self.drain_events)
+        # Gmail libraries are loaded on the first fetch, which reports its own cold-start time.
+        self.log(f"Started in {time.perf_counter() - STARTED:.2f}s.")
 
     def build_ui(self):
         # Main container
@@ -38,7 +117,7 @@ class MailManagerApp(ctk.CTk):
         # Retrieval Method
         ctk.CTkLabel(config_frame, text="Retrieval Method:").grid(row=2, column=0, padx=5, pady=5, sticky="e")
         self.method_var = ctk.StringVar(value="number")
-        self.method_option = ctk.CTkOptionMenu(config_frame, values=["number", "timestamp"], variable=self.method_var)
+        self.method_option = ctk.CTkOptionMenu(config_frame, values=["number", "timestamp", "incremental"], variable=self.method_var)
         self.method_option.grid(row=2, column=1, padx=5, pady=5, sticky="w")
 
         # Number of Emails / Date
@@ -47,9 +126,11 @@ class MailManagerApp(ctk.CTk):
         self.num_entry = ctk.CTkEntry(config_frame, textvariable=self.num_var)
         self.num_entry.grid(row=3, column=1, padx=5, pady=5, sticky="we")
 
-        # Fetch Emails Button
-        fetch_btn = ctk.CTkButton(config_frame, text="Fetch Emails", command=self.on_fetch_emails)
-        fetch_btn.grid(row=4, column=1, padx=5, pady=5, sticky="we")
+        # Fetch Emails and Cancel Buttons
+        self.fetch_btn = ctk.CTkButton(config_frame, text="Fetch Emails", command=self.on_fetch_emails)
+        self.fetch_btn.grid(row=4, column=1, padx=5, pady=5, sticky="we")
+        self.cancel_btn = ctk.CTkButton(config_frame, text="Cancel", command=self.on_cancel, state="disabled")
+        self.cancel_btn.grid(row=4, column=2, padx=5, pady=5, sticky="w")
 
         config_frame.columnconfigure(1, weight=1)
 
@@ -78,12 +159,14 @@ class MailManagerApp(ctk.CTk):
         # Add Rule and Apply Rules Buttons
         add_rule_btn = ctk.CTkButton(rule_frame, text="Add Rule", command=self.on_add_rule)
         add_rule_btn.grid(row=3, column=0, padx=5, pady=5, sticky="we")
-        apply_rules_btn = ctk.CTkButton(rule_frame, text="Apply Rules", command=self.on_apply_rules)
-        apply_rules_btn.grid(row=3, column=1, padx=5, pady=5, sticky="we")
+        self.apply_rules_btn = ctk.CTkButton(rule_frame, text="Apply Rules", command=self.on_apply_rules)
+        self.apply_rules_btn.grid(row=3, column=1, padx=5, pady=5, sticky="we")
 
         rule_frame.columnconfigure(1, weight=1)
 
         # ------------------- LOG / OUTPUT AREA -------------------
+        self.status_var = ctk.StringVar(value="Idle")
+        ctk.CTkLabel(main_frame, textvariable=self.status_var, anchor="w").pack(fill="x", padx=5)
         self.log_text = ctk.CTkTextbox(main_frame, height=200)
         self.log_text.pack(pady=5, fill="both", expand=True)
 
@@ -101,12 +184,15 @@ class MailManagerApp(ctk.CTk):
         db_path = self.db_var.get()
         method = self.method_var.get()
         number_val = self.num_var.get()
-        fetch_emails(
+        self.start_job(
+            "Fetch",
+            fetch_emails,
             credentials_file=credentials_file,
             db_path=db_path,
             retrieval_method=method,
             number_or_date=number_val,
-            log_callback=self.log
+            # A cancelled fetch with the same method and value continues where it stopped.
+            resume=True
         )
 
     def on_add_rule(self):
@@ -135,12 +221,66 @@ class MailManagerApp(ctk.CTk):
     def on_apply_rules(self):
         credentials_file = self.creds_var.get()
         db_path = self.db_var.get()
-        apply_rules(credentials_file=credentials_file, db_path=db_path, log_callback=self.log)
+        self.start_job("Apply rules", apply_rules, credentials_file=credentials_file, db_path=db_path)
 
-    def log(self, msg):
-        self.log_text.insert("end", f"{msg}\n")
+    def on_cancel(self):
+        self.jobs.cancel()
+        self.status_var.set(f"Cancelling {self.jobs.running}...")
+
+    def on_close(self):
+        self.jobs.shutdown()
+        self.destroy()
+
+    def start_job(self, name, job, **kwargs):
+        """
+        Runs `job` on the background worker and switches the buttons to their busy state.
+        """
+        if not self.jobs.submit(name, job, **kwargs):
+            self.log(f"{self.jobs.running} is still running.")
+            return
+        self.fetch_btn.configure(state="disabled")
+        self.apply_rules_btn.configure(state="disabled")
+        self.cancel_btn.configure(state="normal")
+        self.status_var.set(f"{name} running...")
+
+    def drain_events(self):
+        """
+        Timer callback: writes all queued log lines with a single insert and handles
+        finished jobs, then reschedules itself.
+        """
+        lines = []
+        for event in self.jobs.drain():
+            if event[0] == "log":
+                lines.append(str(event[1]))
+                continue
+            _, name, error = event
+            lines.append(f"{name} {'finished' if error is None else 'stopped: ' + error}.")
+            self.status_var.set("Idle")
+            self.fetch_btn.configure(state="normal")
+            self.apply_rules_btn.configure(state="normal")
+            self.cancel_btn.configure(state="disabled")
+        if lines:
+            self.append_log(lines)
+            if self.jobs.running:
+                self.status_var.set(f"{self.jobs.running} running... {lines[-1]}")
+        self.after(DRAIN_INTERVAL_MS, self.drain_events)
+
+    def append_log(self, lines):
+        """
+        Appends lines to the log box, dropping the oldest so at most MAX_LOG_LINES remain.
+        """
+        lines = lines[-MAX_LOG_LINES:]
+        self.log_text.insert("end", "\n".join(lines) + "\n")
+        self.log_lines += len(lines)
+        if self.log_lines > MAX_LOG_LINES:
+            self.log_text.delete("1.0", f"{self.log_lines - MAX_LOG_LINES + 1}.0")
+            self.log_lines = MAX_LOG_LINES
         self.log_text.see("end")
 
+    def log(self, msg):
+        # Thread-safe: lines are queued and written by drain_events on the UI thread.
+        self.jobs.events.put(("log", msg))
+
 if __name__ == '__main__':
     app = MailManagerApp()
     app.mainloop()
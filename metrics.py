@@ -0,0 +1,198 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds, for API latencies and stage timings.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Prefix of every exported Prometheus metric name.
+PROMETHEUS_PREFIX = 'email_'
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())) if labels else ())
+
+def _prometheus_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+class Histogram:
+    """
+    Count, sum and per-bucket counts of observed values, like a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class Metrics:
+    """
+    Thread-safe counters and histograms for the fetch and rules hot paths. Every metric
+    has a name and optional labels, e.g. observe('api_latency_seconds', 0.12,
+    {'method': 'messages.get'}). timer() observes the duration of a with block. Callers
+    record once per API call or per chunk of emails, never per email, so the overhead
+    stays negligible. snapshot() and summary() report one run on a shared instance, and
+    export() writes a Prometheus text file (.prom) or appends JSON lines (.jsonl).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.perf_counter()
+
+    def count(self, name, amount=1, labels=None):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        """
+        Observes the seconds spent in the with block in the `name` histogram.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    def total(self, name):
+        """
+        Returns the sum of counter `name` over all its labels.
+        """
+        with self.lock:
+            return sum(value for (key, _), value in self.counters.items() if key == name)
+
+    def snapshot(self):
+        """
+        Returns the current totals, to be passed to summary() at the end of a run.
+        """
+        return {'time': time.perf_counter(), 'emails': self.total('emails_processed'),
+                'api_calls': self.total('api_calls'), 'http_requests': self.total('http_requests')}
+
+    def summary(self, since=None):
+        """
+        Returns the seconds, emails processed, emails per second, API calls (in quota terms:
+        a batch of 100 gets is 100 calls), HTTP requests and API calls per email since the
+        `since` snapshot, or since the Metrics were created.
+        """
+        start = since or {'time': self.started, 'emails': 0, 'api_calls': 0, 'http_requests': 0}
+        now = self.snapshot()
+        seconds = now['time'] - start['time']
+        emails = now['emails'] - start['emails']
+        api_calls = now['api_calls'] - start['api_calls']
+        return {
+            'seconds': round(seconds, 4),
+            'emails': emails,
+            'emails_per_sec': round(emails / seconds, 1) if seconds > 0 else None,
+            'api_calls': api_calls,
+            'http_requests': now['http_requests'] - start['http_requests'],
+            'api_calls_per_email': round(api_calls / emails, 3) if emails else None,
+        }
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            typed = set()
+            for (name, labels), value in counters:
+                name = f'{PROMETHEUS_PREFIX}{name}_total'
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} counter')
+                lines.append(f'{name}{_prometheus_labels(labels)} {value}')
+            for (name, labels), histogram in histograms:
+                name = PROMETHEUS_PREFIX + name
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f'# TYPE {name} histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_prometheus_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{_prometheus_labels(labels)} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{_prometheus_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """
+        Returns the counters and histogram totals as a JSON-serializable dict.
+        """
+        def label(name, labels):
+            return name + ''.join(f',{key}={value}' for key, value in labels)
+
+        with self.lock:
+            return {
+                'counters': {label(name, labels): value for (name, labels), value in sorted(self.counters.items())},
+                'histograms': {label(name, labels): {'count': histogram.count, 'sum': round(histogram.sum, 6)}
+                               for (name, labels), histogram in sorted(self.histograms.items())},
+            }
+
+    def export(self, path, run=None, summary=None):
+        """
+        Writes the metrics to `path`: a .jsonl path gets one appended line holding `run`
+        (a name such as "fetch"), `summary` and the metrics; any other path is replaced
+        atomically with the Prometheus text format, e.g. for node_exporter's textfile
+        collector.
+        """
+        if path.endswith('.jsonl'):
+            record = {'time': time.time(), 'run': run, 'summary': summary, **self.to_dict()}
+            with open(path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+        else:
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as file:
+                file.write(self.to_prometheus())
+            os.replace(temp_path, path)
+
+def format_summary(name, summary):
+    """
+    Returns a one-line description of a summary() for logging.
+    """
+    line = f"{name}: {summary['emails']} emails in {summary['seconds']:.2f}s"
+    if summary['emails_per_sec'] is not None:
+        line += f" ({summary['emails_per_sec']:.1f}/s)"
+    line += f", {summary['api_calls']} API calls in {summary['http_requests']} HTTP requests"
+    if summary['api_calls_per_email'] is not None:
+        line += f", {summary['api_calls_per_email']:.2f} per email"
+    return line + "."
+
+class LogSampler:
+    """
+    Decides which per-email log lines are written: every `every`-th call to sample()
+    returns True, and none do when `every` is 0 (the default for fetch), so large runs
+    do not spend their time formatting log lines.
+    """
+
+    def __init__(self, every=0):
+        self.every = every
+        self.seen = 0
+
+    def sample(self):
+        if not self.every:
+            return False
+        self.seen += 1
+        return (self.seen - 1) % self.every == 0
@@ -0,0 +1,112 @@
+import base64
+import codecs
+import io
+import re
+from html.parser import HTMLParser
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+
+# Elements whose text is never part of the readable body.
+SKIPPED_HTML_TAGS = ('script', 'style', 'head')
+
+class _HTMLText(HTMLParser):
+    """
+    Collects the text content of an HTML document into `out`, a text buffer.
+    """
+
+    def __init__(self, out):
+        super().__init__(convert_charrefs=True)
+        self.out = out
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_HTML_TAGS:
+            self.skipping += 1
+        elif tag in ('br', 'p', 'div', 'tr', 'li'):
+            self.out.write('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_HTML_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.out.write(data)
+
+def part_charset(part):
+    """
+    Returns the charset declared in a part's Content-Type header, defaulting to utf-8.
+    Unknown charsets also fall back to utf-8.
+    """
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == 'content-type':
+            found = CHARSET_PATTERN.search(header.get('value', ''))
+            if found:
+                try:
+                    return codecs.lookup(found.group(1)).name
+                except LookupError:
+                    break
+    return 'utf-8'
+
+def decode_part(part, max_chars=None):
+    """
+    Decodes the base64url body data of a part in its declared charset. With `max_chars`,
+    only the prefix of the data that can hold that many characters is decoded.
+    """
+    data = part.get('body', {}).get('data', '')
+    if not data:
+        return ''
+    if max_chars is not None:
+        # A character takes at most 4 bytes, and every 4 base64 characters hold 3 bytes.
+        data = data[:(max_chars * 4 + 2) // 3 * 4]
+    data += '=' * (-len(data) % 4)
+    return base64.urlsafe_b64decode(data).decode(part_charset(part), errors='ignore')
+
+def iter_leaf_parts(payload):
+    """
+    Yields the non-multipart parts of a payload tree in document order, walking it with
+    an explicit stack instead of recursion.
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+def extract_body(payload, max_chars=None, html_fallback=True):
+    """
+    Returns the text body of a Gmail message payload: every text/plain part in the
+    (possibly nested) multipart tree, in document order. A single-part payload without a
+    mimeType is read as plain text. If there is no plain text and `html_fallback` is set,
+    the text/html parts are used with their markup stripped. Attachments are skipped.
+    The body is written into one buffer and cut at `max_chars` characters if given.
+    """
+    plain = []
+    html = []
+    for part in iter_leaf_parts(payload):
+        if part.get('filename'):
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain' or (not mime_type and part is payload):
+            plain.append(part)
+        elif mime_type == 'text/html':
+            html.append(part)
+
+    out = io.StringIO()
+    if plain:
+        written = 0
+        for part in plain:
+            remaining = None if max_chars is None else max_chars - written
+            if remaining is not None and remaining <= 0:
+                break
+            written += out.write(decode_part(part, remaining))
+    elif html and html_fallback:
+        parser = _HTMLText(out)
+        for part in html:
+            parser.feed(decode_part(part))
+        parser.close()
+    body = out.getvalue()
+    return body if max_chars is None else body[:max_chars]
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import time
+from collections import deque
+from datetime import datetime, timezone
+from storage import SEARCH_MIN_CHARS, SEARCH_TABLE, fts_phrase
+
+# Rule condition fields and the emails table columns they read.
+FIELD_COLUMNS = {
+    'from': 'sender',
+    'subject': 'subject',
+    'message': 'message',
+    'received_at': 'received_at',
+}
+
+NEGATED_OPERATORS = ("does_not_contain", "does_not_equal")
+DATE_OPERATORS = ("before", "after", "less_than", "greater_than")
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher. Each pattern carries a list of tags, and search()
+    returns the tags of every pattern occurring in the text in a single pass over it.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, tags in patterns.items():
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].extend(tags)
+
+        # Breadth-first pass to fill in failure links and merge outputs along them.
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0) if state else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, text):
+        """
+        Returns the set of tags of all patterns found in `text`.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        # The root only has output for an empty pattern, which occurs in every text.
+        found = set(output[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+class CompiledRules:
+    """
+    rules.json compiled into a matcher. Conditions are grouped by field and operator:
+    `contains`/`does_not_contain` values of a field share one AhoCorasick automaton,
+    `equals`/`does_not_equal` values share one dict, and date conditions on `received_at`
+    become millisecond thresholds. Emails are evaluated column-at-a-time in batches, so
+    every rule is checked in one pass per field. Text matching is case-insensitive.
+    Relative date thresholds are computed for `now`; call set_now() to reuse the matcher
+    at a later time.
+    """
+
+    def __init__(self, rules, now=None):
+        self.rules = rules
+        self.required = []
+        self.negated_total = [0] * len(rules)
+        self.contains = {}
+        self.equals = {}
+        self.date_conditions = []
+        contains_patterns = {}
+        for rule_index, rule in enumerate(rules):
+            conditions = rule.get("conditions", [])
+            predicate = rule.get("predicate", "All")
+            if predicate not in ("All", "Any"):
+                raise ValueError(f"Unsupported predicate: {predicate}")
+            # An "All" rule needs every condition; an "Any" rule (or an empty rule) needs one.
+            self.required.append(len(conditions) if predicate == "All" and conditions else 1)
+            for condition_index, condition in enumerate(conditions):
+                field = condition.get("field", "from")
+                operator = condition.get("operator", "contains")
+                value = condition.get("value", "")
+                negated = operator in NEGATED_OPERATORS
+                tag = (rule_index, condition_index, negated)
+                if field not in FIELD_COLUMNS:
+                    raise ValueError(f"Unsupported field: {field}")
+                if field == 'received_at':
+                    if operator not in DATE_OPERATORS:
+                        raise ValueError(f"Unsupported operator for received_at: {operator}")
+                    self.date_conditions.append((field, operator, value, tag))
+                    continue
+                if operator in ("contains", "does_not_contain"):
+                    contains_patterns.setdefault(field, {}).setdefault(value.casefold(), []).append(tag)
+                elif operator in ("equals", "does_not_equal"):
+                    self.equals.setdefault(field, {}).setdefault(value.casefold(), []).append(tag)
+                else:
+                    raise ValueError(f"Unsupported operator: {operator}")
+                if negated:
+                    self.negated_total[rule_index] += 1
+        for field, patterns in contains_patterns.items():
+            self.contains[field] = AhoCorasick(patterns)
+        self.negated_rules = [rule_index for rule_index, total in enumerate(self.negated_total) if total]
+        date_fields = {date[0] for date in self.date_conditions}
+        self.fields = [field for field in FIELD_COLUMNS
+                       if field in self.contains or field in self.equals or field in date_fields]
+        self.set_now(now)
+
+    def set_now(self, now=None):
+        """
+        Recomputes the date condition thresholds relative to `now` (default: the current time).
+        """
+        now = time.time() if now is None else now
+        self.dates = [(field, *date_threshold(operator, value, now), tag)
+                      for field, operator, value, tag in self.date_conditions]
+
+    def match_batch(self, columns, count):
+        """
+        Evaluates a batch of `count` emails given as {field: list of values} and returns,
+        for each email, the indexes of the rules it matches.
+        """
+        hits = [[] for _ in range(count)]
+        for field in self.fields:
+            column = columns.get(field) or [None] * count
+            if field in self.contains or field in self.equals:
+                texts = [(value or '').casefold() for value in column]
+                if field in self.contains:
+                    search = self.contains[field].search
+                    for row_hits, text in zip(hits, texts):
+                        row_hits.extend(search(text))
+                if field in self.equals:
+                    lookup = self.equals[field]
+                    for row_hits, text in zip(hits, texts):
+                        if text in lookup:
+                            row_hits.extend(lookup[text])
+        for field, comparison, threshold, tag in self.dates:
+            timestamps = [_to_millis(value) for value in columns.get(field) or [None] * count]
+            for row_hits, timestamp in zip(hits, timestamps):
+                if timestamp is not None and (timestamp < threshold if comparison == '<' else timestamp > threshold):
+                    row_hits.append(tag)
+        return [self._resolve(row_hits) for row_hits in hits]
+
+    def _resolve(self, row_hits):
+        """
+        Turns the condition hits of one email into its sorted matching rule indexes.
+        A hit on a negated condition means that condition is not satisfied.
+        """
+        satisfied = {rule_index: self.negated_total[rule_index] for rule_index in self.negated_rules}
+        for rule_index, _, negated in row_hits:
+            satisfied[rule_index] = satisfied.get(rule_index, 0) + (-1 if negated else 1)
+        return sorted(rule_index for rule_index, count in satisfied.items()
+                      if count and count >= self.required[rule_index])
+
+    def match(self, email):
+        """
+        Returns the indexes of all rules matched by `email`, a dict of field name to value.
+        """
+        return self.match_batch({field: [email.get(field)] for field in self.fields}, 1)[0]
+
+def _to_millis(value):
+    """
+    Parses a stored received_at value (Gmail internalDate in milliseconds) or returns None.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def date_threshold(operator, value, now):
+    """
+    Converts a received_at condition into a (comparison, threshold in ms) pair:
+      - "before" / "after": value is a YYYY-MM-DD date (UTC).
+      - "less_than" / "greater_than": value is an age in days, e.g. "7" or "7 days".
+    """
+    if operator in ("before", "after"):
+        day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        return ('<' if operator == "before" else '>'), int(day.timestamp() * 1000)
+    days = float(str(value).split()[0])
+    threshold = int((now - days * 86400) * 1000)
+    # Received less than N days ago means a timestamp after the threshold.
+    return ('>' if operator == "less_than" else '<'), threshold
+
+def condition_to_sql(condition, now, fts=False):
+    """
+    Translates one condition into a parameterized SQL expression over the emails table.
+    Text comparisons use SQLite's case folding, which only folds ASCII letters.
+    With `fts=True`, contains conditions of at least SEARCH_MIN_CHARS characters are
+    answered from the emails_fts trigram index instead of scanning every row.
+    """
+    field = condition.get("field", "from")
+    operator = condition.get("operator", "contains")
+    value = condition.get("value", "")
+    if field not in FIELD_COLUMNS:
+        raise ValueError(f"Unsupported field: {field}")
+    column = FIELD_COLUMNS[field]
+    if field == 'received_at':
+        if operator not in DATE_OPERATORS:
+            raise ValueError(f"Unsupported operator for received_at: {operator}")
+        comparison, threshold = date_threshold(operator, value, now)
+        # received_at is text, and timestamps before 2001-09-09 have fewer than 13 digits, so
+        # text order only matches numeric order between 13-digit values. Later-than thresholds
+        # from 2001 on use that for an index range; the rest compare the values as integers.
+        # The outer bounds exclude empty and non-numeric values.
+        threshold = min(threshold, 10 ** 13 - 1)
+        if comparison == '>' and threshold >= 10 ** 12:
+            return f"({column} > ? AND {column} <= '9999999999999' AND length({column}) = 13)", [str(threshold)]
+        return (f"({column} BETWEEN '0' AND '9999999999999' AND CAST({column} AS INTEGER) {comparison} ?)",
+                [threshold])
+    if fts and operator in ("contains", "does_not_contain") and len(value) >= SEARCH_MIN_CHARS:
+        membership = "IN" if operator == "contains" else "NOT IN"
+        return (f"rowid {membership} (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ?)",
+                [f"{column} : {fts_phrase(value)}"])
+    if operator == "contains":
+        return f"instr(lower(coalesce({column}, '')), lower(?)) > 0", [value]
+    if operator == "does_not_contain":
+        return f"instr(lower(coalesce({column}, '')), lower(?)) = 0", [value]
+    if operator == "equals":
+        if not value:
+            return f"coalesce({column}, '') = ''", []
+        return f"{column} = ? COLLATE NOCASE", [value]
+    if operator == "does_not_equal":
+        return f"coalesce({column}, '') <> ? COLLATE NOCASE", [value]
+    raise ValueError(f"Unsupported operator: {operator}")
+
+def rule_to_sql(rule, now=None, fts=False):
+    """
+    Compiles a rule into a (where clause, parameters) pair selecting the emails it matches.
+    Conditions are joined with AND for an "All" predicate and OR for "Any"; a rule without
+    conditions matches nothing. `fts` is passed to condition_to_sql. Raises ValueError
+    like compile_rules.
+    """
+    now = time.time() if now is None else now
+    predicate = rule.get("predicate", "All")
+    if predicate not in ("All", "Any"):
+        raise ValueError(f"Unsupported predicate: {predicate}")
+    clauses = []
+    params = []
+    for condition in rule.get("conditions", []):
+        clause, condition_params = condition_to_sql(condition, now, fts)
+        clauses.append(clause)
+        params.extend(condition_params)
+    if not clauses:
+        return "0", []
+    joiner = " AND " if predicate == "All" else " OR "
+    return "(" + joiner.join(clauses) + ")", params
+
+def rule_hash(rule):
+    """
+    Returns a stable hash of a rule's predicate and conditions, identifying it in the
+    actions_applied journal. Editing the conditions makes it a new rule.
+    """
+    key = json.dumps([rule.get("predicate", "All"), rule.get("conditions", [])], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+def compile_rules(rules_data, now=None):
+    """
+    Compiles the parsed contents of rules.json into a CompiledRules matcher.
+    Raises ValueError for unsupported predicates, fields or operators.
+    """
+    return CompiledRules(rules_data.get("rules", []), now=now)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from rule_engine import compile_rules
+
+# Bump when CompiledRules changes shape, so stale compiled caches are ignored.
+COMPILED_CACHE_VERSION = 1
+
+def cache_dir():
+    """
+    Returns the per-user directory that holds compiled rule caches.
+    """
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else None
+    base = base or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'email-rules')
+
+def default_cache_path(path):
+    """
+    Returns the compiled cache file for the rules file at `path`: one per rules file and
+    cache version, in cache_dir() rather than next to the rules file.
+    """
+    key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir(), f"{key}.v{COMPILED_CACHE_VERSION}.pickle")
+
+def _write_atomic(path, data):
+    """
+    Writes `data` (bytes) to a temporary file next to `path` and renames it over `path`,
+    so readers see either the old or the new contents, never a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+class RuleStore:
+    """
+    rules.json loaded once and kept in memory. load() only re-reads the file when its
+    mtime, size or inode changed, and only re-parses it when the content hash changed.
+    The compiled matcher is rebuilt on the same condition and pickled to `cache_path`
+    (default_cache_path() by default), so a new process with unchanged rules skips
+    compilation. add_rules() appends any number of rules with a single atomic write.
+    """
+
+    def __init__(self, path="rules.json", cache_path=None):
+        self.path = path
+        self.cache_path = cache_path or default_cache_path(path)
+        self.lock = threading.Lock()
+        self.file_key = None
+        self.content_hash = None
+        self.rules_data = None
+        self.compiled_rules = None
+
+    def _file_key(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _refresh(self):
+        """
+        Re-reads rules.json if it changed on disk. Raises FileNotFoundError or
+        json.JSONDecodeError like json.load.
+        """
+        file_key = self._file_key()
+        if file_key == self.file_key:
+            return
+        with open(self.path, 'rb') as file:
+            content = file.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash != self.content_hash:
+            rules_data = json.loads(content)
+            self.rules_data = rules_data
+            self.content_hash = content_hash
+            self.compiled_rules = None
+        self.file_key = file_key
+
+    def load(self):
+        """
+        Returns the parsed rules.json, re-reading it only if it changed. Raises
+        FileNotFoundError or json.JSONDecodeError if it is missing or invalid.
+        """
+        with self.lock:
+            self._refresh()
+            return self.rules_data
+
+    def compiled(self, now=None):
+        """
+        Returns the CompiledRules matcher for the current rules, with date thresholds
+        relative to `now`. The matcher comes from memory, then from the compiled cache
+        if it matches the content hash, and is compiled (and cached) otherwise.
+        Raises like load() and compile_rules().
+        """
+        with self.lock:
+            self._refresh()
+            if self.compiled_rules is None:
+                self.compiled_rules = self._load_cache()
+            if self.compiled_rules is None:
+                self.compiled_rules = compile_rules(self.rules_data, now=now)
+                self._save_cache()
+            self.compiled_rules.set_now(now)
+            return self.compiled_rules
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'rb') as file:
+                version, content_hash, compiled = pickle.load(file)
+        except (OSError, pickle.PickleError, EOFError, ValueError, AttributeError, ImportError):
+            return None
+        if version != COMPILED_CACHE_VERSION or content_hash != self.content_hash:
+            return None
+        return compiled
+
+    def _save_cache(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            _write_atomic(self.cache_path, pickle.dumps(
+                (COMPILED_CACHE_VERSION, self.content_hash, self.compiled_rules), pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            # The cache is an optimization; an unwritable directory just means recompiling next time.
+            pass
+
+    def add_rules(self, rules):
+        """
+        Appends `rules` to rules.json in one atomic write (temp file and rename). A missing
+        or invalid rules.json is replaced by one holding only the new rules.
+        """
+        with self.lock:
+            try:
+                self._refresh()
+                rules_data = {**self.rules_data, "rules": list(self.rules_data.get("rules", []))}
+            except (FileNotFoundError, json.JSONDecodeError):
+                rules_data = {"rules": []}
+            rules_data["rules"].extend(rules)
+            content = json.dumps(rules_data, indent=4).encode('utf-8')
+            _write_atomic(self.path, content)
+            self.rules_data = rules_data
+            self.content_hash = hashlib.sha256(content).hexdigest()
+            self.compiled_rules = None
+            self.file_key = self._file_key()
+
+# One RuleStore per rules file path, shared within the process.
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_rule_store(path="rules.json"):
+    """
+    Returns the shared RuleStore for `path`.
+    """
+    key = os.path.abspath(path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = RuleStore(path)
+        return _stores[key]
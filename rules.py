@@ -1,31 +1,35 @@
 import json
-import sqlite3
-from googleapiclient.discovery import build
-from authenticate import authenticate
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from googleapiclient.errors import HttpError
+from fetch import hydrate_bodies
+from gmail_client import GmailClient
+from metrics import format_summary
+from rule_engine import FIELD_COLUMNS, compile_rules, rule_hash, rule_to_sql
+from rule_store import get_rule_store
+from session import authenticate, build, cold_start_summary, http_pool
+from storage import EmailStore, connect_readonly, iter_unread_batches
 
 def add_rule(predicate, conditions, actions, log_callback=print):
     """
     Adds a new rule to rules.json. The rule consists of an overall predicate (e.g. "All"),
     a list of conditions, and a list of actions.
     """
-    rule_file = "rules.json"
-    try:
-        with open(rule_file, "r") as file:
-            rules_data = json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        rules_data = {"rules": []}
-    
     new_rule = {
         "predicate": predicate,
         "conditions": conditions,
         "actions": actions
     }
-    rules_data["rules"].append(new_rule)
-    
-    with open(rule_file, "w") as file:
-        json.dump(rules_data, file, indent=4)
-    
-    log_callback(f"Rule added: {new_rule}")
+    add_rules([new_rule], log_callback=log_callback)
+
+def add_rules(new_rules, rule_file="rules.json", log_callback=print):
+    """
+    Appends several rules to rules.json with a single atomic write (see RuleStore.add_rules).
+    """
+    get_rule_store(rule_file).add_rules(new_rules)
+    for new_rule in new_rules:
+        log_callback(f"Rule added: {new_rule}")
 
 def update_rules(sender_email, action, label_name=None):
     """
@@ -44,63 +48,352 @@ def update_rules(sender_email, action, label_name=None):
     add_rule("All", [condition], [final_action])
     print(f"Rule added via update_rules: {sender_email} -> {final_action}")
 
-def apply_rules(credentials_file="credentials.json", db_path="emails.db", log_callback=print):
+# Gmail accepts at most 1,000 ids per batchModify call.
+MAX_BATCH_MODIFY_IDS = 1000
+
+# System label changes made by each fixed action: (labels to add, labels to remove).
+ACTION_LABELS = {
+    "mark_as_read": ((), ("UNREAD",)),
+    "mark_as_unread": (("UNREAD",), ()),
+    "add_star": (("STARRED",), ()),
+}
+
+class LabelCache:
     """
-    Applies rules from rules.json to all unread emails in the SQLite database.
-    Uses the provided credentials file and database path.
+    Gmail label ids indexed by case-folded label name, loaded once per run.
+    If a store is given, the label list is persisted in its labels table and reused for
+    `ttl` seconds. A lookup that misses reloads the list from Gmail once per run, and
+    with `create_missing=True` labels that still do not exist are created.
+    """
+
+    def __init__(self, service, store=None, ttl=3600, create_missing=False, log_callback=print, client=None):
+        self.service = service
+        self.client = client or GmailClient()
+        self.store = store
+        self.ttl = ttl
+        self.create_missing = create_missing
+        self.log_callback = log_callback
+        self.by_name = None
+        self.refreshed = False
+
+    def _set_labels(self, labels):
+        self.by_name = {name.casefold(): label_id for label_id, name in labels}
+
+    def refresh(self):
+        """
+        Reloads the label list from Gmail and persists it to the store.
+        """
+        labels_response = self.client.execute(self.service.users().labels().list(userId='me'), 'labels.list')
+        labels = [(label['id'], label['name']) for label in labels_response.get('labels', [])]
+        self._set_labels(labels)
+        self.refreshed = True
+        if self.store is not None:
+            self.store.save_labels(labels)
+
+    def get_id(self, label_name):
+        """
+        Returns the id of the label named `label_name` (case-insensitive), or None.
+        """
+        if self.by_name is None:
+            cached = self.store.get_labels(self.ttl) if self.store is not None else None
+            if cached is None:
+                self.refresh()
+            else:
+                self._set_labels(cached)
+        key = label_name.casefold()
+        if key not in self.by_name and not self.refreshed:
+            self.refresh()
+        if key not in self.by_name and self.create_missing:
+            label = self.client.execute(self.service.users().labels().create(userId='me', body={
+                "name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"
+            }), 'labels.create')
+            self.by_name[key] = label['id']
+            if self.store is not None:
+                self.store.save_labels([(label_id, name) for name, label_id in self.by_name.items()])
+            self.log_callback(f"Created label '{label_name}'.")
+        return self.by_name.get(key)
+
+class ActionBatch:
+    """
+    Collects rule actions per email and applies them as coalesced batchModify calls.
+    Each email's actions are merged into a single label delta first: duplicates collapse,
+    and when actions conflict (e.g. mark_as_read then mark_as_unread) the later one wins.
+    Emails with the same delta are then sent together in chunks of up to 1,000 ids.
+    Actions added with a rule hash are journaled in the store's actions_applied table once
+    sent, and skipped on later flushes, so each rule acts on each email only once.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def add(self, email_id, actions, rule_hash=None):
+        """
+        Queues `actions` for `email_id`, on behalf of the rule with hash `rule_hash`.
+        """
+        self.pending.setdefault(email_id, []).extend((rule_hash, action) for action in actions)
+
+    @staticmethod
+    def _merge(entries):
+        """
+        Merges (rule_hash, action) entries into an (added, removed) label delta.
+        User labels from move_to_label actions are kept as ("name", label name) keys
+        and resolved to ids when flushed.
+        """
+        adds, removes = set(), set()
+        for _, action in entries:
+            if action.startswith("move_to_label:"):
+                to_add, to_remove = (("name", action.split(":", 1)[1]),), ()
+            elif action in ACTION_LABELS:
+                to_add, to_remove = ACTION_LABELS[action]
+            else:
+                continue
+            for label in to_add:
+                removes.discard(label)
+                adds.add(label)
+            for label in to_remove:
+                adds.discard(label)
+                removes.add(label)
+        return adds, removes
+
+    def flush(self, service, store, log_callback=print, labels=None, client=None, cancel=None):
+        """
+        Sends the pending deltas with users().messages().batchModify and returns one
+        (ids, added, removed, error) tuple per chunk, where `error` is None on success.
+        Entries already in the actions_applied journal are dropped first. For each chunk
+        sent, the journal entries and the resulting is_read state are written to `store`
+        in one transaction. User labels are resolved through `labels`, a LabelCache (one
+        backed by `store` is created if omitted); actions on labels that cannot be resolved
+        are not journaled. Calls go through `client`, a GmailClient that rate-limits and
+        retries them. Once `cancel` is set, no further chunks are sent.
+        """
+        client = client or GmailClient()
+        if labels is None:
+            labels = LabelCache(service, store, log_callback=log_callback, client=client)
+        pending, self.pending = self.pending, {}
+        applied = store.applied_actions(pending)
+        groups = {}
+        entries_by_email = {}
+        for email_id, entries in pending.items():
+            entries = [(rule_hash, action) for rule_hash, action in entries
+                       if (email_id, rule_hash, action) not in applied]
+            adds, removes = self._merge(entries)
+            if adds or removes:
+                groups.setdefault((frozenset(adds), frozenset(removes)), []).append(email_id)
+                entries_by_email[email_id] = entries
+
+        results = []
+        for (adds, removes), email_ids in groups.items():
+            missing = set()
+            add_ids = self._resolve(adds, labels, log_callback, missing)
+            remove_ids = self._resolve(removes, labels, log_callback, missing)
+            if not add_ids and not remove_ids:
+                continue
+            for start in range(0, len(email_ids), MAX_BATCH_MODIFY_IDS):
+                if cancel is not None and cancel.is_set():
+                    return results
+                chunk = email_ids[start:start + MAX_BATCH_MODIFY_IDS]
+                body = {"ids": chunk}
+                if add_ids:
+                    body["addLabelIds"] = add_ids
+                if remove_ids:
+                    body["removeLabelIds"] = remove_ids
+                try:
+                    client.execute(service.users().messages().batchModify(userId='me', body=body),
+                                   'messages.batchModify')
+                except HttpError as error:
+                    log_callback(f"batchModify failed for {len(chunk)} emails (+{add_ids} -{remove_ids}): {error}")
+                    results.append((chunk, add_ids, remove_ids, error))
+                    continue
+                results.append((chunk, add_ids, remove_ids, None))
+                read_state = {}
+                if "UNREAD" in remove_ids or "UNREAD" in add_ids:
+                    is_read = 0 if "UNREAD" in add_ids else 1
+                    read_state = {email_id: is_read for email_id in chunk}
+                journal = [(email_id, rule_hash, action)
+                           for email_id in chunk for rule_hash, action in entries_by_email[email_id]
+                           if rule_hash is not None
+                           and not (action.startswith("move_to_label:") and action.split(":", 1)[1] in missing)]
+                store.record_actions(journal, read_state)
+                client.metrics.count('emails_modified', len(chunk))
+                log_callback(f"batchModify updated {len(chunk)} emails (+{add_ids} -{remove_ids}).")
+        return results
+
+    @staticmethod
+    def _resolve(keys, labels, log_callback, missing=None):
+        """
+        Turns label keys into sorted Gmail label ids, looking user labels up by name.
+        Names that cannot be resolved are added to `missing`.
+        """
+        resolved = set()
+        for key in keys:
+            if isinstance(key, str):
+                resolved.add(key)
+                continue
+            label_id = labels.get_id(key[1])
+            if label_id:
+                resolved.add(label_id)
+            else:
+                log_callback(f"Label '{key[1]}' not found. Create it manually in Gmail.")
+                if missing is not None:
+                    missing.add(key[1])
+        return sorted(resolved)
+
+# Rowid ranges per worker process, so a slow range does not leave other workers idle.
+RANGES_PER_WORKER = 4
+
+def _match_rows(compiled, batches):
+    """
+    Yields (email_id, rule_index) for every row in `batches` (lists of id + field column
+    rows) and every rule it matches.
+    """
+    fields = compiled.fields
+    for batch in batches:
+        values = list(zip(*batch))
+        matches = compiled.match_batch(dict(zip(fields, values[1:])), len(batch))
+        for email_id, rule_indexes in zip(values[0], matches):
+            for rule_index in rule_indexes:
+                yield email_id, rule_index
+
+def match_unread(store, compiled, after_rowid=None):
+    """
+    Yields (email_id, rule_index) for every unread email in `store` (with a rowid above
+    `after_rowid`, if given) and every rule of `compiled` it matches, in rowid order.
+    Only the columns the rules reference are read.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    creds = authenticate(credentials_file)
-    service = build('gmail', 'v1', credentials=creds)
+    if not compiled.fields:
+        return
+    columns = ['id'] + [FIELD_COLUMNS[field] for field in compiled.fields]
+    rowid_range = None if after_rowid is None else (after_rowid + 1, None)
+    yield from _match_rows(compiled, store.iter_unread_batches(columns, rowid_range=rowid_range))
 
-    rule_file = "rules.json"
+# Rules compiled once per worker process by _init_worker.
+_worker_rules = None
+
+def _init_worker(rules_data, now):
+    global _worker_rules
+    _worker_rules = compile_rules(rules_data, now=now)
+
+def _match_rowid_range(db_path, rowid_range):
+    """
+    Worker: matches the unread emails in a rowid range over a read-only connection and
+    returns the matches as parallel (email ids, rule indexes) arrays.
+    """
+    compiled = _worker_rules
+    email_ids = []
+    rule_indexes = array('I')
+    if not compiled.fields:
+        return email_ids, rule_indexes
+    columns = ['id'] + [FIELD_COLUMNS[field] for field in compiled.fields]
+    conn = connect_readonly(db_path)
     try:
-        with open(rule_file, "r") as file:
-            rules_data = json.load(file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        log_callback("No valid rules found in rules.json.")
+        for email_id, rule_index in _match_rows(compiled, iter_unread_batches(conn, columns, rowid_range=rowid_range)):
+            email_ids.append(email_id)
+            rule_indexes.append(rule_index)
+    finally:
         conn.close()
+    return email_ids, rule_indexes
+
+def match_unread_parallel(store, db_path, rules_data, workers, now, after_rowid=None):
+    """
+    Like match_unread, but splits the unread emails into rowid ranges evaluated by
+    `workers` processes. Each worker compiles the rules once (with the same `now`, so
+    date conditions agree) and reads `db_path` over its own read-only connection.
+    Ranges are merged in order, so the result is identical to match_unread.
+    """
+    bounds = store.unread_rowid_bounds(after_rowid)
+    if bounds is None:
         return
+    low, high = bounds
+    count = workers * RANGES_PER_WORKER
+    step = max(1, -(-(high - low + 1) // count))
+    ranges = [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(rules_data, now)) as pool:
+        for email_ids, rule_indexes in pool.map(_match_rowid_range, [db_path] * len(ranges), ranges):
+            yield from zip(email_ids, rule_indexes)
+
+def apply_rules(credentials_file="credentials.json", db_path="emails.db", log_callback=print, sql_pushdown=False,
+                create_missing_labels=False, label_ttl=3600, client=None, workers=1, store=None, after_rowid=None,
+                metrics_file=None, cancel=None):
+    """
+    Applies rules from rules.json to all unread emails in the SQLite database.
+    Uses the provided credentials file and database path. Matching runs in Python
+    (match_unread, or match_unread_parallel with `workers`) or, with `sql_pushdown=True`,
+    in SQLite (rule_to_sql); actions are sent through an ActionBatch. `after_rowid` limits
+    the run to emails stored after that rowid, and setting `cancel` (a threading.Event)
+    stops it between batchModify chunks.
+    """
+    owns_store = store is None
+    store = store or EmailStore(db_path)
+    close_store = store.close if owns_store else store.flush
+    try:
+        creds = authenticate(credentials_file)
+        service = build('gmail', 'v1', credentials=creds)
+        summary = cold_start_summary()
+        if summary:
+            log_callback(summary)
+        client = client or GmailClient(pool=http_pool(creds))
+        started = client.metrics.snapshot()
+        now = time.time()
+
+        rule_store = get_rule_store("rules.json")
+        try:
+            rules_data = rule_store.load()
+        except (FileNotFoundError, json.JSONDecodeError):
+            log_callback("No valid rules found in rules.json.")
+            return
+
+        # Compile the rules once and read only the columns they reference.
+        try:
+            if sql_pushdown:
+                queries = [rule_to_sql(rule, now=now, fts=store.fts) for rule in rules_data.get("rules", [])]
+            else:
+                compiled = rule_store.compiled(now)
+        except ValueError as error:
+            log_callback(f"Invalid rule in rules.json: {error}")
+            return
+
+        if sql_pushdown:
+            needs_bodies = any(condition.get("field", "from") == "message"
+                               for rule in rules_data.get("rules", []) for condition in rule.get("conditions", []))
+        else:
+            needs_bodies = "message" in compiled.fields
+        if needs_bodies:
+            hydrate_bodies(service, store, client=client, log_callback=log_callback, cancel=cancel,
+                           after_rowid=after_rowid)
+
+        hashes = [rule_hash(rule) for rule in rules_data.get("rules", [])]
+        actions = ActionBatch()
+        client.metrics.count('emails_processed', store.count_unread(after_rowid), {'stage': 'rules'})
+        with client.metrics.timer('rule_evaluation_seconds'):
+            if sql_pushdown:
+                for rule_index, (rule, (where, params)) in enumerate(zip(rules_data.get("rules", []), queries)):
+                    for email_id in store.iter_unread_matching(where, params, after_rowid=after_rowid):
+                        actions.add(email_id, rule.get("actions", []), hashes[rule_index])
+            else:
+                # Worker processes need the database on disk, not an in-memory one.
+                if workers > 1 and db_path != ':memory:':
+                    matches = match_unread_parallel(store, db_path, rules_data, workers, now, after_rowid)
+                else:
+                    matches = match_unread(store, compiled, after_rowid)
+                for email_id, rule_index in matches:
+                    actions.add(email_id, compiled.rules[rule_index].get("actions", []), hashes[rule_index])
+        client.metrics.count('emails_matched', len(actions.pending))
 
-    cursor.execute('SELECT id, sender FROM emails WHERE is_read = 0')
-    emails = cursor.fetchall()
-
-    for email_id, sender in emails:
-        for rule in rules_data.get("rules", []):
-            # Check if any condition is met (case-insensitive)
-            if any(condition.get("value", "").lower() in sender.lower() 
-                   for condition in rule.get("conditions", [])):
-                for action in rule.get("actions", []):
-                    if action.startswith("move_to_label:"):
-                        label_name = action.split(":", 1)[1]
-                        labels_response = service.users().labels().list(userId='me').execute()
-                        labels = labels_response.get('labels', [])
-                        label_id = next((label['id'] for label in labels 
-                                         if label['name'].lower() == label_name.lower()), None)
-                        if label_id:
-                            service.users().messages().modify(
-                                userId='me', id=email_id, body={"addLabelIds": [label_id]}
-                            ).execute()
-                            log_callback(f"Moved email {email_id} to label {label_name}.")
-                        else:
-                            log_callback(f"Label '{label_name}' not found. Create it manually in Gmail.")
-                    elif action == "mark_as_read":
-                        service.users().messages().modify(
-                            userId='me', id=email_id, body={"removeLabelIds": ["UNREAD"]}
-                        ).execute()
-                        log_callback(f"Marked email {email_id} as read.")
-                    elif action == "mark_as_unread":
-                        service.users().messages().modify(
-                            userId='me', id=email_id, body={"addLabelIds": ["UNREAD"]}
-                        ).execute()
-                        log_callback(f"Marked email {email_id} as unread.")
-                    elif action == "add_star":
-                        service.users().messages().modify(
-                            userId='me', id=email_id, body={"addLabelIds": ["STARRED"]}
-                        ).execute()
-                        log_callback(f"Starred email {email_id}.")
-    conn.close()
+        labels = LabelCache(service, store, ttl=label_ttl, create_missing=create_missing_labels,
+                            log_callback=log_callback, client=client)
+        actions.flush(service, store, log_callback, labels=labels, client=client, cancel=cancel)
+        if client.stats['retries']:
+            log_callback(client.summary())
+        if cancel is not None and cancel.is_set():
+            log_callback("Applying rules cancelled; emails updated so far are journaled.")
+            return
+        summary = client.metrics.summary(started)
+        log_callback(format_summary("Rules", summary))
+        if metrics_file:
+            client.metrics.export(metrics_file, "rules", summary)
+    finally:
+        # Commits the journal of applied actions even if the run fails or is cancelled.
+        close_store()
 
 if __name__ == '__main__':
     print("Select an action:")
@@ -0,0 +1,57 @@
+import sqlite3
+import sys
+from storage import SEARCH_MIN_CHARS, EmailStore
+
+def search_emails(query, db_path="emails.db", limit=20, offset=0, log_callback=print, syntax=False):
+    """
+    Full-text searches the stored emails and logs one "id: snippet" line per match,
+    best matches first. Returns the (id, snippet) pairs. Terms are matched literally
+    unless `syntax` is True (see EmailStore.search); problems are logged, not raised.
+    """
+    if not syntax:
+        short = [term for term in query.split() if len(term) < SEARCH_MIN_CHARS]
+        if short:
+            log_callback(f"Ignoring terms shorter than {SEARCH_MIN_CHARS} characters, which the index "
+                         f"cannot match: {' '.join(short)}")
+        query = ' '.join(term for term in query.split() if len(term) >= SEARCH_MIN_CHARS)
+        if not query:
+            return []
+    store = EmailStore(db_path)
+    try:
+        results = store.search(query, limit, offset, syntax)
+    except sqlite3.OperationalError as error:
+        log_callback(f"Search failed: {error}")
+        return []
+    finally:
+        store.close()
+    if not results:
+        log_callback("No matching emails found.")
+    for email_id, snippet in results:
+        log_callback(f"{email_id}: {snippet}")
+    return results
+
+def rebuild_index(db_path="emails.db", log_callback=print):
+    """
+    Creates the full-text index of a database if needed and rebuilds it from its emails table.
+    """
+    store = EmailStore(db_path)
+    try:
+        rebuilt = store.rebuild_search_index()
+    finally:
+        store.close()
+    if rebuilt:
+        log_callback("Search index rebuilt.")
+    else:
+        log_callback("Full-text search is not supported by this SQLite build.")
+    return rebuilt
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    syntax = '--fts' in args
+    args = [arg for arg in args if arg != '--fts']
+    if args == ['--rebuild']:
+        rebuild_index()
+    elif args:
+        search_emails(' '.join(args), syntax=syntax)
+    else:
+        print("Usage: python search.py [--fts] <query> | python search.py --rebuild")
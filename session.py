@@ -0,0 +1,107 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import authenticate as auth
+from transport import HttpPool
+
+# Access tokens expiring within this margin are refreshed before being handed out.
+REFRESH_MARGIN = timedelta(minutes=5)
+
+_lock = threading.RLock()
+_credentials = {}
+_services = {}
+_pools = {}
+_timings = {}
+_reported = False
+
+def _expiring(creds):
+    """
+    Returns True if `creds` can be refreshed and expire within REFRESH_MARGIN.
+    """
+    expiry = getattr(creds, 'expiry', None)
+    if expiry is None or not getattr(creds, 'refresh_token', None):
+        return False
+    # google-auth keeps expiry as a naive UTC datetime.
+    return expiry - datetime.now(timezone.utc).replace(tzinfo=None) < REFRESH_MARGIN
+
+def authenticate(credentials_file="credentials.json"):
+    """
+    Returns the credentials for `credentials_file`, loaded once per process with
+    authenticate.authenticate. Tokens about to expire are refreshed and saved here,
+    before a Gmail call can fail on them.
+    """
+    with _lock:
+        creds = _credentials.get(credentials_file)
+        if creds is None:
+            started = time.perf_counter()
+            creds = auth.authenticate(credentials_file)
+            _credentials[credentials_file] = creds
+            _timings.setdefault('credentials', time.perf_counter() - started)
+        if _expiring(creds):
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+            auth.save_token(creds)
+        return creds
+
+def build(serviceName="gmail", version="v1", credentials=None, **kwargs):
+    """
+    Returns a googleapiclient service, built once per process for the same name, version
+    and credentials. googleapiclient is imported on the first call, and the service is
+    built from the discovery document bundled with google-api-python-client
+    (static_discovery), so it is read from local disk rather than fetched. The service
+    holds a single httplib2 connection: threads sharing it must pass their own `http` to
+    execute(), as fetch's pipeline does.
+    """
+    key = (serviceName, version, id(credentials))
+    with _lock:
+        entry = _services.get(key)
+        if entry is None:
+            started = time.perf_counter()
+            from googleapiclient.discovery import build as build_service
+            imported = time.perf_counter()
+            service = build_service(serviceName, version, credentials=credentials, static_discovery=True, **kwargs)
+            _timings.setdefault('imports', imported - started)
+            _timings.setdefault('service', time.perf_counter() - imported)
+            # Keep the credentials alive so their id() is not reused by another object.
+            entry = _services[key] = (credentials, service)
+        return entry[1]
+
+def http_pool(credentials=None):
+    """
+    Returns the process-wide HttpPool for `credentials`, shared by every fetch and rules
+    run so their connections stay warm.
+    """
+    with _lock:
+        entry = _pools.get(id(credentials))
+        if entry is None:
+            entry = _pools[id(credentials)] = (credentials, HttpPool(credentials))
+        return entry[1]
+
+def cold_start_summary():
+    """
+    Returns a one-line report of the time spent loading credentials, importing the Google
+    API client and building the service, the first time it is called after they happened
+    in this process; None otherwise.
+    """
+    global _reported
+    with _lock:
+        if _reported or not _timings:
+            return None
+        _reported = True
+        parts = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in _timings.items())
+        return f"Gmail session ready in {sum(_timings.values()):.2f}s ({parts})."
+
+def reset():
+    """
+    Forgets the cached credentials, services and connection pools, e.g. after
+    token.pickle was replaced.
+    """
+    global _reported
+    with _lock:
+        _credentials.clear()
+        _services.clear()
+        for _, pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        _timings.clear()
+        _reported = False
@@ -0,0 +1,416 @@
+import sqlite3
+import time
+from urllib.parse import quote
+
+EMAIL_COLUMNS = {
+    'id': 'TEXT PRIMARY KEY',
+    'sender': 'TEXT',
+    'subject': 'TEXT',
+    'received_at': 'TEXT',
+    'message': 'TEXT',
+    'is_read': 'INTEGER DEFAULT 0',
+}
+
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+]
+
+INDEXES = {
+    'idx_emails_is_read': 'is_read',
+    'idx_emails_sender': 'sender COLLATE NOCASE',
+    'idx_emails_received_at': 'received_at',
+}
+
+# Ids per IN (...) lookup, kept below SQLite's default host parameter limit.
+LOOKUP_CHUNK_SIZE = 500
+
+# Optional full-text index over the text columns, an external-content FTS5 table kept in
+# sync with emails by triggers. The trigram tokenizer makes every substring of 3+
+# characters searchable, so the index can also answer rule `contains` conditions. It
+# roughly doubles the database and slows inserts several-fold, so it is only created on
+# request (EmailStore(fts=True) or python search.py --rebuild).
+SEARCH_COLUMNS = ('sender', 'subject', 'message')
+SEARCH_TABLE = 'emails_fts'
+SEARCH_MIN_CHARS = 3
+
+INSERT_EMAIL_SQL = (
+    'INSERT OR IGNORE INTO emails (id, sender, subject, received_at, message, is_read) '
+    'VALUES (?, ?, ?, ?, ?, ?)'
+)
+
+def init_schema(conn):
+    """
+    Creates the emails, sync_state, labels and actions_applied tables and their indexes
+    if they do not exist.
+    Columns missing from an emails table created by an older version are added.
+    Returns whether the optional full-text index exists (see init_search_index).
+    """
+    cursor = conn.cursor()
+    columns = ',\n'.join(f'{name} {definition}' for name, definition in EMAIL_COLUMNS.items())
+    cursor.execute(f'CREATE TABLE IF NOT EXISTS emails (\n{columns}\n)')
+    cursor.execute('PRAGMA table_info(emails)')
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, definition in EMAIL_COLUMNS.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE emails ADD COLUMN {name} {definition}')
+    for index_name, column in INDEXES.items():
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON emails ({column})')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS labels (
+            id TEXT PRIMARY KEY,
+            name TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS actions_applied (
+            email_id TEXT,
+            rule_hash TEXT,
+            action TEXT,
+            applied_at REAL,
+            PRIMARY KEY (email_id, rule_hash, action)
+        ) WITHOUT ROWID
+    ''')
+    conn.commit()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,))
+    return cursor.fetchone() is not None
+
+def init_search_index(conn):
+    """
+    Creates the emails_fts index and the triggers that keep it in sync with emails.
+    A newly created index over existing emails is filled immediately. Returns False
+    (leaving the database unchanged) if this SQLite build lacks FTS5 or trigram support.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,))
+    existed = cursor.fetchone() is not None
+    columns = ', '.join(SEARCH_COLUMNS)
+    new_columns = ', '.join(f'new.{column}' for column in SEARCH_COLUMNS)
+    old_columns = ', '.join(f'old.{column}' for column in SEARCH_COLUMNS)
+    insert = f'INSERT INTO {SEARCH_TABLE} (rowid, {columns}) VALUES (new.rowid, {new_columns});'
+    delete = (f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rowid, {columns}) "
+              f"VALUES ('delete', old.rowid, {old_columns});")
+    try:
+        cursor.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+                {columns}, content='emails', content_rowid='rowid', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return False
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN {insert} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN {delete} END')
+    cursor.execute(f'CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF {columns} ON emails '
+                   f'BEGIN {delete} {insert} END')
+    if not existed:
+        cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')")
+    conn.commit()
+    return True
+
+def connect_readonly(db_path):
+    """
+    Opens a read-only connection to an existing database, e.g. for a worker process.
+    """
+    return sqlite3.connect(f'file:{quote(db_path)}?mode=ro', uri=True)
+
+def iter_unread_batches(conn, columns=('id', 'sender'), fetch_size=1000, rowid_range=None):
+    """
+    Yields lists of up to `fetch_size` rows of `columns` for unread emails in rowid order,
+    restricted to rowids in [start, end) if `rowid_range` is given (end None: no limit).
+    """
+    cursor = conn.cursor()
+    where = 'is_read = 0'
+    params = []
+    if rowid_range is not None:
+        start, end = rowid_range
+        where += ' AND rowid >= ?'
+        params.append(start)
+        if end is not None:
+            where += ' AND rowid < ?'
+            params.append(end)
+    cursor.execute(f'SELECT {", ".join(columns)} FROM emails WHERE {where} ORDER BY rowid', params)
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        yield rows
+
+def fts_phrase(text):
+    """
+    Quotes `text` as an FTS5 phrase so it is matched literally.
+    """
+    return '"' + text.replace('"', '""') + '"'
+
+class EmailStore:
+    """
+    Single long-lived connection to the emails database.
+    Inserts are buffered and written with executemany, committing every `batch_rows`
+    rows or `batch_seconds` seconds, whichever comes first. Call close() (or flush())
+    to write anything still buffered.
+    With `fts=True` the emails_fts full-text index is created if missing; `fts` is then
+    True if the index exists (see search()).
+    """
+
+    def __init__(self, db_path='emails.db', batch_rows=500, batch_seconds=2.0, fts=False):
+        self.conn = sqlite3.connect(db_path)
+        self.cursor = self.conn.cursor()
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        self.fts = init_schema(self.conn)
+        if fts and not self.fts:
+            self.fts = init_search_index(self.conn)
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self._pending = []
+        self._pending_ids = set()
+        self._last_commit = time.monotonic()
+
+    def insert_emails(self, rows):
+        """
+        Buffers (id, sender, subject, received_at, message, is_read) rows for insertion.
+        Rows whose id is already stored are ignored when the buffer is flushed.
+        """
+        for row in rows:
+            self._pending.append(row)
+            self._pending_ids.add(row[0])
+        if len(self._pending) >= self.batch_rows or time.monotonic() - self._last_commit >= self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes buffered rows and commits the current transaction.
+        """
+        if self._pending:
+            self.cursor.executemany(INSERT_EMAIL_SQL, self._pending)
+            self._pending = []
+            self._pending_ids = set()
+        self.conn.commit()
+        self._last_commit = time.monotonic()
+
+    def filter_unknown_ids(self, msg_ids):
+        """
+        Returns the ids from `msg_ids` that are neither stored nor buffered, preserving order.
+        Lookups are done with one IN (...) query per LOOKUP_CHUNK_SIZE ids.
+        """
+        known = set()
+        for start in range(0, len(msg_ids), LOOKUP_CHUNK_SIZE):
+            chunk = msg_ids[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            self.cursor.execute(f'SELECT id FROM emails WHERE id IN ({placeholders})', chunk)
+            known.update(row[0] for row in self.cursor.fetchall())
+        return [msg_id for msg_id in msg_ids if msg_id not in known and msg_id not in self._pending_ids]
+
+    def update_read_state(self, read_state):
+        """
+        Sets is_read for stored emails from a {message id: is_read} mapping.
+        """
+        self.cursor.executemany(
+            'UPDATE emails SET is_read = ? WHERE id = ?',
+            [(is_read, msg_id) for msg_id, is_read in read_state.items()]
+        )
+
+    def applied_actions(self, email_ids):
+        """
+        Returns the (email_id, rule_hash, action) entries of the actions_applied journal
+        for `email_ids`, looked up on its primary key LOOKUP_CHUNK_SIZE ids at a time.
+        """
+        applied = set()
+        email_ids = list(email_ids)
+        for start in range(0, len(email_ids), LOOKUP_CHUNK_SIZE):
+            chunk = email_ids[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            self.cursor.execute(
+                f'SELECT email_id, rule_hash, action FROM actions_applied WHERE email_id IN ({placeholders})', chunk
+            )
+            applied.update(self.cursor.fetchall())
+        return applied
+
+    def record_actions(self, entries, read_state):
+        """
+        Journals applied (email_id, rule_hash, action) entries and sets is_read from a
+        {message id: is_read} mapping, committing both in one transaction. Buffered
+        inserts are written first.
+        """
+        self.flush()
+        applied_at = time.time()
+        self.cursor.executemany(
+            'INSERT OR IGNORE INTO actions_applied (email_id, rule_hash, action, applied_at) VALUES (?, ?, ?, ?)',
+            [(email_id, rule_hash, action, applied_at) for email_id, rule_hash, action in entries]
+        )
+        self.update_read_state(read_state)
+        self.conn.commit()
+
+    def unhydrated_ids(self, email_ids=None, unread_only=True, after_rowid=None):
+        """
+        Returns the ids of stored emails without a downloaded body (message IS NULL),
+        optionally restricted to `email_ids`, to unread emails and to rowids above `after_rowid`.
+        """
+        self.flush()
+        where = 'message IS NULL AND rowid > ?' + (' AND is_read = 0' if unread_only else '')
+        if email_ids is None:
+            self.cursor.execute(f'SELECT id FROM emails WHERE {where}', (after_rowid or 0,))
+            return [row[0] for row in self.cursor.fetchall()]
+        found = []
+        email_ids = list(email_ids)
+        for start in range(0, len(email_ids), LOOKUP_CHUNK_SIZE):
+            chunk = email_ids[start:start + LOOKUP_CHUNK_SIZE]
+            placeholders = ', '.join('?' * len(chunk))
+            self.cursor.execute(f'SELECT id FROM emails WHERE {where} AND id IN ({placeholders})',
+                                [after_rowid or 0, *chunk])
+            found.extend(row[0] for row in self.cursor.fetchall())
+        return found
+
+    def update_bodies(self, bodies):
+        """
+        Sets the message column from (body, id) pairs.
+        """
+        self.cursor.executemany('UPDATE emails SET message = ? WHERE id = ?', bodies)
+
+    def iter_unread_batches(self, columns=('id', 'sender'), fetch_size=1000, rowid_range=None):
+        """
+        Yields lists of up to `fetch_size` rows of `columns` for unread emails in rowid order,
+        optionally restricted to a [start, end) `rowid_range`.
+        """
+        return iter_unread_batches(self.conn, columns, fetch_size, rowid_range)
+
+    def max_rowid(self):
+        """
+        Returns the highest rowid in the emails table (0 if it is empty), after writing
+        buffered rows. Rows inserted later get higher rowids, so it marks what is new.
+        """
+        self.flush()
+        self.cursor.execute('SELECT max(rowid) FROM emails')
+        return self.cursor.fetchone()[0] or 0
+
+    def count_unread(self, after_rowid=None):
+        """
+        Returns the number of unread emails, only counting rowids above `after_rowid` if given.
+        """
+        self.flush()
+        self.cursor.execute('SELECT COUNT(*) FROM emails WHERE is_read = 0 AND rowid > ?', (after_rowid or 0,))
+        return self.cursor.fetchone()[0]
+
+    def unread_rowid_bounds(self, after_rowid=None):
+        """
+        Returns the (lowest, highest) rowid of the unread emails, only counting rowids above
+        `after_rowid` if given, or None if there are none.
+        """
+        self.flush()
+        self.cursor.execute('SELECT min(rowid), max(rowid) FROM emails WHERE is_read = 0 AND rowid > ?',
+                            (after_rowid or 0,))
+        low, high = self.cursor.fetchone()
+        return None if low is None else (low, high)
+
+    def iter_unread(self, columns=('id', 'sender'), fetch_size=1000):
+        """
+        Yields rows of `columns` for unread emails, fetching `fetch_size` rows at a time.
+        """
+        for rows in self.iter_unread_batches(columns, fetch_size):
+            yield from rows
+
+    def iter_unread_matching(self, where, params=(), fetch_size=1000, after_rowid=None):
+        """
+        Yields the ids of unread emails matching a parameterized `where` clause, only
+        considering rowids above `after_rowid` if given.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(f'SELECT id FROM emails WHERE is_read = 0 AND rowid > ? AND ({where})',
+                       [after_rowid or 0] + list(params))
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+
+    def search(self, query, limit=20, offset=0, syntax=False):
+        """
+        Full-text searches sender, subject and message and returns (id, snippet) pairs,
+        best matches first. Each whitespace-separated term of `query` is matched literally
+        as a case-insensitive substring of 3+ characters, and all terms must match. With
+        `syntax=True`, `query` is passed to FTS5 as is ("phrases", OR, NOT, subject:...)
+        and raises sqlite3.OperationalError if invalid. Matches in the snippet are
+        wrapped in [brackets]. Raises sqlite3.OperationalError if there is no index.
+        """
+        if not self.fts:
+            raise sqlite3.OperationalError("No search index; run python search.py --rebuild to create it.")
+        if not syntax:
+            query = ' '.join(fts_phrase(term) for term in query.split())
+        self.flush()
+        self.cursor.execute(f'''
+            SELECT emails.id, snippet({SEARCH_TABLE}, -1, '[', ']', '...', 64)
+            FROM {SEARCH_TABLE} JOIN emails ON emails.rowid = {SEARCH_TABLE}.rowid
+            WHERE {SEARCH_TABLE} MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        ''', (query, limit, offset))
+        return self.cursor.fetchall()
+
+    def rebuild_search_index(self):
+        """
+        Creates the emails_fts index if missing and refills it from the emails table, e.g.
+        for a database whose index is out of sync. Returns False if this SQLite build lacks
+        FTS5 trigram support.
+        """
+        if not self.fts:
+            self.fts = init_search_index(self.conn)
+            return self.fts
+        self.flush()
+        self.cursor.execute(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('rebuild')")
+        self.conn.commit()
+        return True
+
+    def get_state(self, key):
+        """
+        Returns the stored sync_state value for `key`, or None if it has not been recorded.
+        """
+        self.cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        """
+        Records a sync_state value for `key`, replacing any previous value.
+        """
+        self.cursor.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def delete_state(self, key):
+        """
+        Removes the sync_state value for `key`, if any.
+        """
+        self.cursor.execute('DELETE FROM sync_state WHERE key = ?', (key,))
+
+    def get_labels(self, max_age):
+        """
+        Returns the cached Gmail labels as (id, name) pairs, or None if the cache is
+        missing or older than `max_age` seconds.
+        """
+        cached_at = self.get_state('labels_cached_at')
+        if cached_at is None or time.time() - float(cached_at) > max_age:
+            return None
+        self.cursor.execute('SELECT id, name FROM labels')
+        return self.cursor.fetchall()
+
+    def save_labels(self, labels):
+        """
+        Replaces the cached Gmail labels with `labels`, a list of (id, name) pairs.
+        """
+        self.cursor.execute('DELETE FROM labels')
+        self.cursor.executemany('INSERT INTO labels (id, name) VALUES (?, ?)', labels)
+        self.set_state('labels_cached_at', time.time())
+        self.conn.commit()
+
+    def close(self):
+        """
+        Flushes buffered rows and closes the connection.
+        """
+        self.flush()
+        self.conn.close()
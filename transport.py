@@ -0,0 +1,96 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 4
+# Seconds before a socket operation on a Gmail connection times out.
+DEFAULT_TIMEOUT = 60
+
+class _Connection:
+    """
+    Wraps an (authorized) httplib2.Http and sets the Accept-Encoding header of every
+    request. Other attributes are passed through, so googleapiclient can use it as its http.
+    """
+
+    def __init__(self, http, accept_encoding):
+        self.http = http
+        self.accept_encoding = accept_encoding
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        headers = {key: value for key, value in (headers or {}).items() if key.lower() != 'accept-encoding'}
+        headers['accept-encoding'] = self.accept_encoding
+        return self.http.request(uri, method, body, headers, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+class HttpPool:
+    """
+    Thread-safe pool of up to `size` keep-alive connections to the Gmail API, each an
+    httplib2.Http (authorized with `credentials` if given) that is only used by one
+    thread at a time. Connections are opened on demand and reused, so each pays the
+    TLS handshake once. `timeout` is the socket timeout in seconds; with `gzip=False`
+    responses are requested uncompressed. httplib2 and google_auth_httplib2 are
+    imported when the first connection is opened.
+    """
+
+    def __init__(self, credentials=None, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, gzip=True):
+        self.credentials = credentials
+        self.size = size
+        self.timeout = timeout
+        self.accept_encoding = 'gzip, deflate' if gzip else 'identity'
+        self.available = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.stats = {'opened': 0, 'acquired': 0, 'waited': 0}
+
+    def _open(self):
+        import httplib2
+        http = httplib2.Http(timeout=self.timeout)
+        if self.credentials is not None:
+            import google_auth_httplib2
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+        return _Connection(http, self.accept_encoding)
+
+    def ensure_size(self, size):
+        """
+        Grows the pool to at least `size` connections, e.g. to match a worker count.
+        """
+        with self.lock:
+            self.size = max(self.size, size)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Lends a connection for the duration of the with block, opening one if the pool
+        has room and waiting for one to be returned otherwise.
+        """
+        try:
+            http = self.available.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.stats['opened'] < self.size
+                if can_open:
+                    self.stats['opened'] += 1
+                else:
+                    self.stats['waited'] += 1
+            http = self._open() if can_open else self.available.get()
+        with self.lock:
+            self.stats['acquired'] += 1
+        try:
+            yield http
+        finally:
+            self.available.put(http)
+
+    def close(self):
+        """
+        Closes the idle connections; connections currently lent out are left alone.
+        """
+        while True:
+            try:
+                http = self.available.get_nowait()
+            except queue.Empty:
+                break
+            connection = getattr(http.http, 'http', http.http)
+            connection.close()
+            with self.lock:
+                self.stats['opened'] -= 1